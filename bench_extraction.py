@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Extraction benchmark
+Compares the old per-call YoutubeDL + four-pass format scan with the
+warm per-thread extractor, fast path and single-pass format selection.
+
+    python bench_extraction.py                       # format selection only (offline)
+    python bench_extraction.py dQw4w9WgXcQ ...       # also time real extractions
+"""
+
+import argparse
+import statistics
+import time
+
+import main
+
+
+def legacy_select(formats):
+    """The original selection: one full scan per preferred extension"""
+    for priority in ['m4a', 'mp3', 'webm', 'mp4']:
+        for fmt in formats:
+            if (fmt.get('acodec') != 'none' and
+                fmt.get('vcodec') == 'none' and
+                fmt.get('ext') == priority):
+                return fmt
+    for fmt in formats:
+        if fmt.get('acodec') != 'none':
+            return fmt
+    return None
+
+
+def synthetic_formats(with_m4a=True):
+    """A format list ordered like yt-dlp's: storyboards, audio-only, then video"""
+    formats = [{'format_id': f'sb{i}', 'ext': 'mhtml', 'acodec': 'none', 'vcodec': 'none'} for i in range(4)]
+    formats += [{'format_id': f'25{i}', 'ext': 'webm', 'acodec': 'opus', 'vcodec': 'none'} for i in range(3)]
+    if with_m4a:
+        formats += [{'format_id': f'13{i}', 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none'} for i in range(2)]
+    formats += [{'format_id': str(160 + i), 'ext': 'mp4', 'acodec': 'none', 'vcodec': 'avc1'} for i in range(40)]
+    formats.append({'format_id': '18', 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1'})
+    return formats
+
+
+def timed(func, *args):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def bench_selection(rounds):
+    for label, with_m4a in (("m4a available", True), ("webm only", False)):
+        formats = synthetic_formats(with_m4a)
+        info = {'formats': formats}
+        assert legacy_select(formats) is main.select_audio_format(info)
+
+        for name, func, arg in (("legacy 4-pass scan", legacy_select, formats),
+                                ("single-pass select", main.select_audio_format, info)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                func(arg)
+            elapsed = time.perf_counter() - start
+            print(f"{label:<14} {name:<20} {elapsed / rounds * 1e6:8.2f} us/call")
+
+    # What extract_info really returns: the 'format' selector's pick merged into the info dict
+    formats = synthetic_formats()
+    info = dict(formats[7], url='https://example.invalid/audio', formats=formats)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        main.select_audio_format(info)
+    elapsed = time.perf_counter() - start
+    print(f"{'yt-dlp pick':<14} {'single-pass select':<20} {elapsed / rounds * 1e6:8.2f} us/call")
+
+
+def cold_extract(video_id):
+    """The original engine: a fresh YoutubeDL with full format enumeration per call"""
+    with main.yt_dlp.YoutubeDL(main.get_yt_dlp_options()) as ydl:
+        info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+    return legacy_select(info.get('formats', []))
+
+
+def warm_extract(video_id):
+    return main.select_audio_format(main.extract_video_info(video_id))
+
+
+def bench_extraction(video_ids, repeat):
+    for name, func in (("cold (per-call YoutubeDL)", cold_extract),
+                       ("warm (per-thread, fast path)", warm_extract)):
+        walls, cpus = [], []
+        for _ in range(repeat):
+            for video_id in video_ids:
+                fmt, wall, cpu = timed(func, video_id)
+                if not fmt:
+                    print(f"  no audio format for {video_id}")
+                walls.append(wall)
+                cpus.append(cpu)
+        print(f"{name:<30} wall median {statistics.median(walls):6.3f}s  "
+              f"cpu median {statistics.median(cpus):6.3f}s  ({len(walls)} extractions)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("video_ids", nargs="*", help="YouTube video IDs to extract")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the video IDs")
+    parser.add_argument("--rounds", type=int, default=20000, help="Format selection iterations")
+    args = parser.parse_args()
+
+    bench_selection(args.rounds)
+    if args.video_ids:
+        if not main.YT_DLP_AVAILABLE:
+            raise SystemExit("yt-dlp not available. Please install yt-dlp")
+        bench_extraction(args.video_ids, args.repeat)
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
-from fastapi.responses import FileResponse, StreamingResponse, JSONResponse , HTMLResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse , HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import os
@@ -17,10 +17,33 @@ from pathlib import Path
 import aiofiles
 from pydantic import BaseModel
 import logging
-from urllib.parse import quote, unquote
-import requests
+from urllib.parse import quote, unquote, urlparse, parse_qs
+import httpx
 from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
 from fastapi.templating import Jinja2Templates
+from starlette.requests import ClientDisconnect
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import time
+import sqlite3
+import hashlib
+import struct
+import unicodedata
+import base64
+import math
+import random
+import sys
+import io
+import traceback
+import types
+import cProfile
+import pstats
+import marshal
+import secrets
+from collections import OrderedDict, deque
+from bisect import bisect_left
 PORT = int(os.environ.get("PORT", 8000))
 app = FastAPI(
     title="SpotifyClone API",
@@ -48,6 +71,14 @@ async def api_status():
         "youtube_available": True,
         "ytdlp_available": True
     })
+# Streaming multipart parser (python-multipart renamed its module in 0.0.13)
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ImportError:
+    import multipart
+    from multipart.multipart import parse_options_header
+
 # YouTube search imports
 try:
     from youtubesearchpython import VideosSearch
@@ -64,6 +95,13 @@ except ImportError:
     YT_DLP_AVAILABLE = False
     print("Warning: yt-dlp not available. Install with: pip install yt-dlp")
 
+# Optional faster JSON encoder for room broadcasts
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 
 # Configure CORS
 app.add_middleware(
@@ -89,15 +127,117 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 STATIC_DIR.mkdir(exist_ok=True)
 CACHE_DIR.mkdir(exist_ok=True)
 
+# Content-addressed song storage and its index
+OBJECTS_DIR = UPLOAD_DIR / "objects"
+LIBRARY_DB_PATH = UPLOAD_DIR / "library.sqlite3"
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {".mp3", ".wav", ".m4a", ".flac", ".ogg"}
+AUDIO_MIME_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".m4a": "audio/mp4",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg"
+}
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+UPLOAD_CHUNK_SIZE = 256 * 1024  # Bytes buffered before each write to disk
+MULTIPART_OVERHEAD = 64 * 1024  # Allowance for boundaries and part headers in Content-Length
+
+# Listen-together room registry
+ROOM_IDLE_TTL = int(os.environ.get("ROOM_IDLE_TTL", 3600))  # Seconds a room with no connections is kept
+ROOM_REAP_INTERVAL = 60  # Seconds between idle room sweeps
+ROOM_REAP_BATCH = 1000  # Rooms removed before a sweep yields to the event loop
+ROOM_SEND_TIMEOUT = float(os.environ.get("ROOM_SEND_TIMEOUT", 5))  # Seconds a single WebSocket send may take
+ROOM_SEND_QUEUE = int(os.environ.get("ROOM_SEND_QUEUE", 64))  # Outbound messages buffered per connection
+ROOM_SLOW_CONSUMER_POLICY = os.environ.get("ROOM_SLOW_CONSUMER_POLICY", "drop_oldest")  # Or "disconnect"
+ROOM_PROTOCOL_VERSION = 2  # Sequenced, server-clocked deltas
+ROOM_DELTA_HISTORY = 64  # Recent deltas kept per room so reconnecting clients can catch up
+ROOM_EVENT_WINDOW = float(os.environ.get("ROOM_EVENT_WINDOW", 0.1))  # Seconds over which host play/pause/seek bursts merge
+ROOM_SYNC_INTERVAL = float(os.environ.get("ROOM_SYNC_INTERVAL", 1))  # Minimum seconds between a listener's sync_requests
+ROOM_PING_INTERVAL = float(os.environ.get("ROOM_PING_INTERVAL", 25))  # Seconds of silence before the server pings a socket
+ROOM_PING_TIMEOUT = float(os.environ.get("ROOM_PING_TIMEOUT", 10))  # Seconds to answer a ping before the socket is reaped
+ROOM_HEARTBEAT_TICK = 1.0  # Timer wheel resolution in seconds
+ROOM_BACKEND = os.environ.get("ROOM_BACKEND", "memory")  # "memory" or "redis" to share rooms between processes
+ROOM_BACKEND_URL = os.environ.get("ROOM_BACKEND_URL", "redis://localhost:6379/0")  # redis://[:password@]host:port/db or unix:///path
+ROOM_BACKEND_PREFIX = os.environ.get("ROOM_BACKEND_PREFIX", "melodrift")  # Key and channel namespace
+ROOM_BACKEND_TIMEOUT = float(os.environ.get("ROOM_BACKEND_TIMEOUT", 2))  # Seconds per backend command
 
 # Cache for stream URLs to avoid repeated yt-dlp calls
-active_rooms: Dict[str, Dict] = {}
-room_connections: Dict[str, List[WebSocket]] = {}
-stream_cache = {}
-CACHE_DURATION = timedelta(hours=1)  # Cache URLs for 1 hour
+CACHE_DURATION = timedelta(hours=1)  # TTL for URLs without an expire= parameter
+STREAM_CACHE_MAX_ENTRIES = int(os.environ.get("STREAM_CACHE_MAX_ENTRIES", 2000))
+STREAM_CACHE_MAX_BYTES = int(os.environ.get("STREAM_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+STREAM_CACHE_SAFETY_MARGIN = int(os.environ.get("STREAM_CACHE_SAFETY_MARGIN", 600))  # Seconds before googlevideo expiry
+PERSISTENT_CACHE_ENABLED = os.environ.get("PERSISTENT_CACHE_ENABLED", "1") == "1"
+PERSISTENT_CACHE_PATH = CACHE_DIR / "streams.sqlite3"
+STREAM_VALIDATION_ENABLED = os.environ.get("STREAM_VALIDATION_ENABLED", "1") == "1"
+STREAM_VALIDATION_TIMEOUT = float(os.environ.get("STREAM_VALIDATION_TIMEOUT", 5))
+
+# Audio relay settings
+RELAY_CHUNK_SIZE = 64 * 1024
+RELAY_SHARE_LIMIT = int(os.environ.get("RELAY_SHARE_LIMIT", 32 * 1024 * 1024))  # Bytes after which a fetch stops taking new readers
+RELAY_BUFFER_LIMIT = int(os.environ.get("RELAY_BUFFER_LIMIT", 4 * 1024 * 1024))  # Bytes buffered ahead of the slowest reader once a fetch stops sharing
+RELAY_PLAYBACK = os.environ.get("RELAY_PLAYBACK", "true").lower() in ("1", "true", "yes")  # Web player streams through /stream
+RELAY_PASSTHROUGH_HEADERS = ("content-type", "content-length", "content-range", "accept-ranges", "last-modified", "etag")
+
+# Local copies of hot YouTube tracks
+AUDIO_CACHE_DIR = CACHE_DIR / "audio"
+AUDIO_CACHE_HOT_PLAYS = int(os.environ.get("AUDIO_CACHE_HOT_PLAYS", 3))  # Plays before a track is stored locally
+AUDIO_CACHE_PLAY_WINDOW = float(os.environ.get("AUDIO_CACHE_PLAY_WINDOW", 60))  # Seconds in which repeat lookups of a track count as one play
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get("AUDIO_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+AUDIO_CACHE_MAX_DOWNLOADS = int(os.environ.get("AUDIO_CACHE_MAX_DOWNLOADS", 2))
+AUDIO_CACHE_TRACKED_VIDEOS = 10000  # Play counters kept in memory
+AUDIO_CACHE_EXTENSIONS = {"audio/mp4": ".m4a", "audio/webm": ".webm", "audio/mpeg": ".mp3", "audio/ogg": ".ogg"}
+
+# yt-dlp extraction pool settings
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", 4))
+EXTRACTION_QUEUE_LIMIT = int(os.environ.get("EXTRACTION_QUEUE_LIMIT", 16))  # Jobs allowed to wait for a worker
+EXTRACTION_TIMEOUT = float(os.environ.get("EXTRACTION_TIMEOUT", 30))  # Seconds per extraction job
+EXTRACTION_RETRY_AFTER = int(os.environ.get("EXTRACTION_RETRY_AFTER", 5))  # Retry-After sent when saturated
+EXTRACTION_FAST_PATH = os.environ.get("EXTRACTION_FAST_PATH", "true").lower() in ("1", "true", "yes")  # Skip HLS/DASH manifests
+EXTRACTOR_RECYCLE_AFTER = int(os.environ.get("EXTRACTOR_RECYCLE_AFTER", 200))  # Extractions before a worker's YoutubeDL is rebuilt
+AUDIO_FORMAT_PRIORITIES = {'m4a': 0, 'mp3': 1, 'webm': 2, 'mp4': 3}  # Preferred audio-only containers, best first
+
+# Batch stream resolution
+BATCH_STREAM_MAX_IDS = int(os.environ.get("BATCH_STREAM_MAX_IDS", 100))
+BATCH_STREAM_CONCURRENCY = int(os.environ.get("BATCH_STREAM_CONCURRENCY", EXTRACTION_WORKERS))  # Misses resolved at once per batch
+
+# Background prefetch of upcoming tracks
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+PREFETCH_RATE = float(os.environ.get("PREFETCH_RATE", 20))  # Prefetch extractions started per minute at most
+PREFETCH_RESERVED_WORKERS = int(os.environ.get("PREFETCH_RESERVED_WORKERS", 1))  # Extraction workers kept free for foreground requests
+PREFETCH_MAX_PENDING = int(os.environ.get("PREFETCH_MAX_PENDING", 200))
+PREFETCH_UPCOMING_LIMIT = 5  # Upcoming tracks taken from a single song_change or request
+PREFETCH_TRACKED = 1000  # Prefetched videos remembered for hit accounting
+PREFETCH_BACKOFF = 0.5  # Seconds between checks while the extraction pool is busy
+
+# YouTube search pool and result cache
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", 4))
+SEARCH_QUEUE_LIMIT = int(os.environ.get("SEARCH_QUEUE_LIMIT", 16))
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", 15))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 900))  # Seconds
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 1000))
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get("SEARCH_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+SEARCH_MAX_UPSTREAM_CALLS = 10  # Continuation pages fetched for a single request at most
+
+# Prometheus metrics
+METRICS_LOOP_LAG_INTERVAL = float(os.environ.get("METRICS_LOOP_LAG_INTERVAL", 0.5))  # Seconds between event-loop lag probes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Seconds
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)  # Seconds, for in-loop work
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))  # Bytes per second, 64 KiB/s to 1 GiB/s
+
+# Event-loop stall watchdog and request profiling
+LOOP_STALL_THRESHOLD = float(os.environ.get("LOOP_STALL_THRESHOLD", 0.25))  # Seconds the loop may block before its stack is logged (0 disables)
+LOOP_STALL_TICK = 0.05  # Watchdog heartbeat and check interval in seconds
+LOOP_STALL_KEEP = 20  # Recent stalls kept for /admin/stalls
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # Enables /admin endpoints and the X-Profile header
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "cprofile")  # Or "sample" for low-overhead stack sampling
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))  # Fraction of requests profiled without the header
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))  # Profiles kept in memory for download
+PROFILE_REPORT_LINES = 60  # Functions listed in a text report
+PROFILE_EXCLUDED_PATHS = ("/admin", "/metrics", "/static")  # Never sampled
 
 # Data models
 class SearchResult(BaseModel):
@@ -111,6 +251,7 @@ class SearchResult(BaseModel):
 class SearchResponse(BaseModel):
     results: List[SearchResult]
     total: int
+    next_cursor: Optional[str] = None
 
 class PlayResponse(BaseModel):
     stream_url: str
@@ -118,11 +259,17 @@ class PlayResponse(BaseModel):
     duration: Optional[str] = None
     error: Optional[str] = None
 
+class BatchStreamRequest(BaseModel):
+    video_ids: List[str]
+
 class UploadResponse(BaseModel):
     filename: str
     original_name: str
     size: int
     message: str
+    sha256: Optional[str] = None
+    duplicate: bool = False
+    metadata: Optional[dict] = None
 
 class HealthResponse(BaseModel):
     status: str
@@ -185,132 +332,1737 @@ def create_error_response(error_msg: str, detail: str, suggestions: List[str] =
         suggestions=suggestions
     )
 
+# Prometheus metrics - observations are plain attribute updates on the event loop;
+# all formatting happens when /metrics is scraped
+def format_metric_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def format_metric_labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = (
+        f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for name, value in labels
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Monotonic counter (event loop only, so no lock)"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name: str, labels: tuple):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """Fixed-bucket histogram: observe() is a bisect and two additions (event loop only)"""
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # Per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: tuple):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (('le', format_metric_value(float(bound))),), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """Named metric families plus collectors that read existing stats() counters at scrape time"""
+
+    def __init__(self):
+        self._families: Dict[str, list] = {}  # name -> [type, help, {label tuple: metric}]
+        self._collectors = []
+
+    def _child(self, kind: str, name: str, help: str, labels: dict, factory):
+        family = self._families.setdefault(name, [kind, help, {}])
+        if family[0] != kind:
+            raise ValueError(f"Metric {name} is already registered as a {family[0]}")
+        key = tuple(sorted(labels.items()))
+        if key not in family[2]:
+            family[2][key] = factory()
+        return family[2][key]
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._child("counter", name, help, labels, Counter)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._child("histogram", name, help, labels, functools.partial(Histogram, buckets))
+
+    def collector(self, func):
+        """Register func() yielding (name, type, help, labels dict, value) tuples"""
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)"""
+        lines = []
+        for name, (kind, help, children) in self._families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in children.items():
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    lines.append(f"{sample}{format_metric_labels(sample_labels)} {format_metric_value(value)}")
+
+        collected: Dict[str, list] = {}
+        for func in self._collectors:
+            try:
+                for name, kind, help, labels, value in func():
+                    collected.setdefault(name, [kind, help, []])[2].append((tuple(labels.items()), value))
+            except Exception as e:
+                logger.warning(f"Metrics collector {func.__name__} failed: {e}")
+        for name, (kind, help, samples) in collected.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_metric_labels(labels)} {format_metric_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+extraction_seconds = metrics.histogram(
+    "melodrift_extraction_seconds", "yt-dlp extraction time, including the wait for a worker")
+search_upstream_seconds = metrics.histogram(
+    "melodrift_search_upstream_seconds", "YouTube search page fetch time, including the wait for a worker")
+upload_throughput = metrics.histogram(
+    "melodrift_upload_throughput_bytes_per_second", "Upload receive rate per completed upload", THROUGHPUT_BUCKETS)
+upload_bytes = metrics.counter("melodrift_upload_bytes_total", "Bytes received in completed uploads")
+library_scan_seconds = metrics.histogram(
+    "melodrift_library_scan_seconds", "Library index query time for /library", FAST_BUCKETS)
+song_bytes_served = metrics.counter("melodrift_song_bytes_served_total", "Body bytes sent by /songs/{filename}")
+broadcast_fanout_seconds = metrics.histogram(
+    "melodrift_room_broadcast_fanout_seconds", "Time to encode a room broadcast and queue it for every local connection",
+    FAST_BUCKETS)
+broadcast_delivery_seconds = metrics.histogram(
+    "melodrift_room_send_delay_seconds", "Time from queueing a room message to finishing its WebSocket send",
+    FAST_BUCKETS)
+loop_lag_seconds = metrics.histogram(
+    "melodrift_event_loop_lag_seconds", "How late the event loop woke a periodic probe", FAST_BUCKETS)
+
+
+class LoopLagMonitor:
+    """Sleeps a fixed interval and records how much later than requested the loop woke it"""
+
+    def __init__(self, interval: float, histogram: Histogram):
+        self.interval = interval
+        self.histogram = histogram
+        self.last = 0.0
+        self.max = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - expected)
+            self.max = max(self.max, self.last)
+            self.histogram.observe(self.last)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = spawn_background(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+loop_lag = LoopLagMonitor(METRICS_LOOP_LAG_INTERVAL, loop_lag_seconds)
+
+
+class CountedFileResponse(FileResponse):
+    """FileResponse that adds the body bytes it actually sends (ranges included) to a counter"""
+
+    def __init__(self, *args, counter: Counter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counter = counter
+
+    async def __call__(self, scope, receive, send):
+        async def counting_send(message):
+            if message['type'] == 'http.response.body':
+                self.counter.inc(len(message.get('body', b'')))
+            await send(message)
+        await super().__call__(scope, receive, counting_send)
+
+# Event-loop diagnostics - stall watchdog and opt-in request profiling
+class StallWatchdog:
+    """Helper thread that notices when the event loop stops turning and logs the stack it is stuck in"""
+
+    def __init__(self, threshold: float, tick: float, keep: int, histogram: Histogram):
+        self.threshold = threshold
+        self.tick = tick
+        self.histogram = histogram
+        self.beat = time.monotonic()
+        self.recent: deque = deque(maxlen=keep)  # Most recent stalls, newest last
+        self.stalls = 0
+        self.longest = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._reported = None  # Beat of the stall the watchdog thread last logged
+
+    def _beat(self):
+        now = time.monotonic()
+        # How long the loop was held past the expected wake-up, known once it is free again
+        late = now - self.beat - self.tick
+        if late >= self.threshold:
+            self.histogram.observe(late)
+            self.longest = max(self.longest, late)
+            if self._reported == self.beat and self.recent:
+                self.recent[-1]['duration'] = round(late, 4)
+        self.beat = now
+        self._handle = self._loop.call_later(self.tick, self._beat)
+
+    def _watch(self):
+        while not self._stopped.wait(self.tick):
+            beat = self.beat
+            stalled = time.monotonic() - beat - self.tick
+            if stalled < self.threshold or beat == self._reported:
+                continue
+            # Report each stall once, with the stack as it is while the loop is still blocked
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            self.stalls += 1
+            self.recent.append({'at': time.time(), 'duration': round(stalled, 4), 'stack': stack})
+            self._reported = beat
+            logger.warning(f"Event loop blocked for over {stalled * 1000:.0f}ms, currently running:\n{stack}")
+
+    def start(self):
+        if self.threshold <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self.beat = time.monotonic()
+        self._handle = self._loop.call_later(self.tick, self._beat)
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def stats(self) -> dict:
+        return {
+            'threshold': self.threshold,
+            'running': self._thread is not None and self._thread.is_alive(),
+            'stalls': self.stalls,
+            'longest': round(self.longest, 4)
+        }
+
+
+loop_stall_seconds = metrics.histogram(
+    "melodrift_event_loop_stall_seconds", "Event-loop stalls longer than LOOP_STALL_THRESHOLD", LATENCY_BUCKETS)
+watchdog = StallWatchdog(LOOP_STALL_THRESHOLD, LOOP_STALL_TICK, LOOP_STALL_KEEP, loop_stall_seconds)
+
+
+class StackSampler:
+    """Collapsed stacks of one thread, sampled from a helper thread (flamegraph.pl / speedscope input)"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> bytes:
+        self._stopped.set()
+        self._thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.items()).encode()
+
+
+class RequestProfiler:
+    """Opt-in per-request cProfile or stack sampling, keeping the latest results for /admin/profiles
+
+    The profile covers the event-loop thread for the lifetime of the request, so other
+    requests interleaved on the loop show up too; one request is profiled at a time.
+    """
+
+    def __init__(self, enabled: bool, mode: str, sample_rate: float, interval: float, keep: int):
+        self.enabled = enabled
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.keep = keep
+        self.results: "OrderedDict[str, dict]" = OrderedDict()
+        self.active = False
+        self.captured = 0
+        self.skipped = 0
+
+    def requested_mode(self, scope) -> Optional[str]:
+        """The mode to profile this request with, or None"""
+        if not self.enabled or scope['path'].startswith(PROFILE_EXCLUDED_PATHS):
+            return None
+        headers = dict(scope['headers'])
+        value = headers.get(b'x-profile', b'').decode('latin-1').lower()
+        if value and admin_token_valid(headers.get(b'x-admin-token', b'').decode('latin-1')):
+            return value if value in ("cprofile", "sample") else self.mode
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return self.mode
+        return None
+
+    def begin(self, mode: str):
+        if self.active:
+            self.skipped += 1
+            return None
+        try:
+            if mode == "sample":
+                session = StackSampler(threading.get_ident(), self.interval)
+                session.start()
+            else:
+                session = cProfile.Profile()
+                session.enable()
+        except ValueError:
+            # Another profiler (e.g. a debugger or coverage) already owns the interpreter hook
+            self.skipped += 1
+            return None
+        self.active = True
+        return session
+
+    def finish(self, session, scope, status: int, elapsed: float, profile_id: str):
+        self.active = False
+        if isinstance(session, StackSampler):
+            mode, data = "sample", session.stop()
+        else:
+            session.disable()
+            session.create_stats()
+            mode, data = "cprofile", marshal.dumps(session.stats)  # Same layout as Profile.dump_stats
+        self.results[profile_id] = {
+            'id': profile_id,
+            'mode': mode,
+            'method': scope['method'],
+            'path': scope['path'],
+            'status': status,
+            'duration': round(elapsed, 4),
+            'at': time.time(),
+            'size': len(data),
+            'data': data
+        }
+        while len(self.results) > self.keep:
+            self.results.popitem(last=False)
+        self.captured += 1
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'mode': self.mode,
+            'sample_rate': self.sample_rate,
+            'kept': len(self.results),
+            'captured': self.captured,
+            'skipped': self.skipped
+        }
+
+
+def admin_token_valid(token: str) -> bool:
+    return bool(ADMIN_TOKEN) and secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+def require_admin(request: Request):
+    """Admin endpoints are hidden unless ADMIN_TOKEN is set, and need it in X-Admin-Token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not admin_token_valid(request.headers.get("x-admin-token", "")):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+profiler = RequestProfiler(PROFILE_ENABLED, PROFILE_MODE, PROFILE_SAMPLE_RATE, PROFILE_SAMPLE_INTERVAL, PROFILE_KEEP)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles the requests RequestProfiler selects and tags them with X-Profile-Id"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        mode = profiler.requested_mode(scope) if scope['type'] == 'http' else None
+        session = profiler.begin(mode) if mode else None
+        if session is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex[:12]
+        status = 0
+        started = time.perf_counter()
+
+        async def profiled_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message['headers'] = list(message.get('headers', [])) + [(b'x-profile-id', profile_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            profiler.finish(session, scope, status, time.perf_counter() - started, profile_id)
+
+
+app.add_middleware(ProfilingMiddleware)
+
+# Audio metadata probing - pure Python, reads only headers/trailers (never the whole file)
+AUDIO_PROBE_HEAD = 64 * 1024
+AUDIO_PROBE_TAIL = 8 * 1024
+
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+ID3_TEXT_FRAMES = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album',
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album'
+}
+VORBIS_COMMENT_FIELDS = {'TITLE': 'title', 'ARTIST': 'artist', 'ALBUM': 'album'}
+MP4_TAG_ATOMS = {b'\xa9nam': 'title', b'\xa9ART': 'artist', b'\xa9alb': 'album'}
+MP4_MAX_DEPTH = 16  # Container nesting followed at most (real files go about 8 deep)
+WAV_INFO_FIELDS = {b'INAM': 'title', b'IART': 'artist', b'IPRD': 'album'}
+
+
+def _read_at(f, offset: int, length: int) -> bytes:
+    f.seek(offset)
+    return f.read(length)
+
+
+def _syncsafe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _decode_id3_text(data: bytes) -> str:
+    if not data:
+        return ''
+    encoding, body = data[0], data[1:]
+    if encoding == 1:
+        text = body.decode('utf-16', 'replace')
+    elif encoding == 2:
+        text = body.decode('utf-16-be', 'replace')
+    elif encoding == 3:
+        text = body.decode('utf-8', 'replace')
+    else:
+        text = body.decode('latin-1', 'replace')
+    return text.split('\x00')[0].strip()
+
+
+def _parse_vorbis_comment(data: bytes, meta: dict):
+    """Vorbis comment block (shared by FLAC, Ogg Vorbis and Opus)"""
+    vendor_length = struct.unpack_from('<I', data, 0)[0]
+    pos = 4 + vendor_length
+    count = struct.unpack_from('<I', data, pos)[0]
+    pos += 4
+    for _ in range(count):
+        if pos + 4 > len(data):
+            break
+        length = struct.unpack_from('<I', data, pos)[0]
+        pos += 4
+        key, _, value = data[pos:pos + length].decode('utf-8', 'replace').partition('=')
+        pos += length
+        field = VORBIS_COMMENT_FIELDS.get(key.upper())
+        if field and value and field not in meta:
+            meta[field] = value.strip()
+
+
+def _probe_mp3(f, size: int, head: bytes, meta: dict):
+    meta['codec'] = 'mp3'
+    audio_start = 0
+
+    if head[:3] == b'ID3' and len(head) >= 10:
+        major = head[3]
+        tag_size = _syncsafe(head[6:10])
+        audio_start = 10 + tag_size + (10 if head[5] & 0x10 else 0)
+        pos = 10
+        end = min(10 + tag_size, len(head))
+        id_length, header_length = (3, 6) if major == 2 else (4, 10)
+        while pos + header_length <= end:
+            frame_id = head[pos:pos + id_length]
+            if not frame_id.strip(b'\x00'):
+                break  # Padding
+            if major == 2:
+                frame_size = int.from_bytes(head[pos + 3:pos + 6], 'big')
+            elif major == 4:
+                frame_size = _syncsafe(head[pos + 4:pos + 8])
+            else:
+                frame_size = struct.unpack_from('>I', head, pos + 4)[0]
+            body = head[pos + header_length:pos + header_length + frame_size]
+            field = ID3_TEXT_FRAMES.get(frame_id.decode('latin-1'))
+            if field and field not in meta:
+                meta[field] = _decode_id3_text(body)
+            pos += header_length + frame_size
+
+    # Locate the first MPEG frame after the tag
+    frame_data = head[audio_start:] if audio_start < len(head) else _read_at(f, audio_start, 4096)
+    offset = 0
+    while offset + 4 <= len(frame_data):
+        if frame_data[offset] == 0xFF and (frame_data[offset + 1] & 0xE0) == 0xE0:
+            version_bits = (frame_data[offset + 1] >> 3) & 0x3
+            layer_bits = (frame_data[offset + 1] >> 1) & 0x3
+            bitrate_index = frame_data[offset + 2] >> 4
+            rate_index = (frame_data[offset + 2] >> 2) & 0x3
+            if version_bits != 1 and layer_bits != 0 and bitrate_index not in (0, 15) and rate_index != 3:
+                break
+        offset += 1
+    else:
+        return
+
+    version = {3: 1, 2: 2, 0: 2.5}[version_bits]
+    layer = 4 - layer_bits
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index]
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    mono = (frame_data[offset + 3] >> 6) == 3
+    if layer == 1:
+        samples_per_frame = 384
+    elif layer == 2 or version == 1:
+        samples_per_frame = 1152
+    else:
+        samples_per_frame = 576
+
+    audio_bytes = size - audio_start - offset
+    if _read_at(f, size - 128, 3) == b'TAG':
+        audio_bytes -= 128
+
+    # A Xing/Info or VBRI header gives the exact frame count for VBR files
+    frames = None
+    side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+    xing = frame_data[offset + 4 + side_info:offset + 4 + side_info + 12]
+    if xing[:4] in (b'Xing', b'Info') and len(xing) >= 12 and struct.unpack('>I', xing[4:8])[0] & 1:
+        frames = struct.unpack('>I', xing[8:12])[0]
+    vbri = frame_data[offset + 36:offset + 54]
+    if frames is None and vbri[:4] == b'VBRI' and len(vbri) >= 18:
+        frames = struct.unpack('>I', vbri[14:18])[0]
+
+    if frames:
+        meta['duration'] = frames * samples_per_frame / sample_rate
+        meta['bitrate'] = int(audio_bytes * 8 / meta['duration'] / 1000) if meta['duration'] else bitrate
+    elif bitrate:
+        meta['bitrate'] = bitrate
+        meta['duration'] = audio_bytes * 8 / (bitrate * 1000)
+
+
+def _probe_id3v1(f, size: int, meta: dict):
+    """ID3v1 trailer as a fallback for fields the ID3v2 tag didn't provide"""
+    if size < 128:
+        return
+    tag = _read_at(f, size - 128, 128)
+    if tag[:3] != b'TAG':
+        return
+    for field, start in (('title', 3), ('artist', 33), ('album', 63)):
+        value = tag[start:start + 30].split(b'\x00')[0].decode('latin-1').strip()
+        if value and field not in meta:
+            meta[field] = value
+
+
+def _probe_flac(f, size: int, meta: dict):
+    meta['codec'] = 'flac'
+    pos = 4
+    while pos + 4 <= size:
+        header = _read_at(f, pos, 4)
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], 'big')
+        if block_type == 0:
+            info = _read_at(f, pos + 4, 18)
+            sample_rate = int.from_bytes(info[10:13], 'big') >> 4
+            total_samples = int.from_bytes(info[13:18], 'big') & 0xFFFFFFFFF
+            if sample_rate and total_samples:
+                meta['duration'] = total_samples / sample_rate
+        elif block_type == 4:
+            _parse_vorbis_comment(_read_at(f, pos + 4, min(length, AUDIO_PROBE_HEAD)), meta)
+        if header[0] & 0x80:
+            break  # Last metadata block
+        pos += 4 + length
+
+
+def _probe_ogg(f, size: int, head: bytes, meta: dict):
+    granule_rate, pre_skip = None, 0
+    if b'\x01vorbis' in head[:512]:
+        meta['codec'] = 'vorbis'
+        ident = head.index(b'\x01vorbis') + 7
+        granule_rate = struct.unpack_from('<I', head, ident + 5)[0]
+        comment = head.find(b'\x03vorbis')
+        if comment != -1:
+            _parse_vorbis_comment(head[comment + 7:], meta)
+    elif b'OpusHead' in head[:512]:
+        meta['codec'] = 'opus'
+        ident = head.index(b'OpusHead') + 8
+        pre_skip = struct.unpack_from('<H', head, ident + 2)[0]
+        granule_rate = 48000
+        comment = head.find(b'OpusTags')
+        if comment != -1:
+            _parse_vorbis_comment(head[comment + 8:], meta)
+    if not granule_rate:
+        return
+
+    # The last page's granule position is the total sample count
+    tail = _read_at(f, max(0, size - AUDIO_PROBE_TAIL), AUDIO_PROBE_TAIL)
+    last_page = tail.rfind(b'OggS')
+    if last_page != -1 and last_page + 14 <= len(tail):
+        granule = struct.unpack_from('<q', tail, last_page + 6)[0]
+        if granule > 0:
+            meta['duration'] = max(0, granule - pre_skip) / granule_rate
+
+
+def _probe_mp4(f, size: int, meta: dict):
+    containers = {b'moov', b'udta', b'meta', b'ilst', b'trak', b'mdia', b'minf', b'stbl'}
+
+    def walk(start: int, end: int, depth: int):
+        pos = start
+        while pos + 8 <= end:
+            header = _read_at(f, pos, 16)
+            atom_size, kind = struct.unpack('>I4s', header[:8])
+            header_size = 8
+            if atom_size == 1:
+                atom_size = struct.unpack('>Q', header[8:16])[0]
+                header_size = 16
+            elif atom_size == 0:
+                atom_size = end - pos
+            if atom_size < header_size:
+                return
+            body = pos + header_size
+            if kind == b'mvhd':
+                data = _read_at(f, body, 32)
+                if data[0] == 1:
+                    timescale, duration = struct.unpack('>IQ', data[20:32])
+                else:
+                    timescale, duration = struct.unpack('>II', data[12:20])
+                if timescale:
+                    meta['duration'] = duration / timescale
+            elif kind == b'stsd' and 'codec' not in meta:
+                fourcc = _read_at(f, body + 12, 4)
+                meta['codec'] = {b'mp4a': 'aac', b'alac': 'alac'}.get(fourcc, fourcc.decode('latin-1'))
+            elif kind in MP4_TAG_ATOMS:
+                data = _read_at(f, body, min(atom_size - header_size, 1024))
+                if data[4:8] == b'data':
+                    meta.setdefault(MP4_TAG_ATOMS[kind], data[16:].decode('utf-8', 'replace').strip())
+            elif kind in containers and depth < MP4_MAX_DEPTH:
+                # 'meta' is a full atom with 4 bytes of version/flags before its children
+                walk(body + (4 if kind == b'meta' else 0), pos + atom_size, depth + 1)
+            pos += atom_size
+
+    walk(0, size, 0)
+
+
+def _probe_wav(f, size: int, meta: dict):
+    meta['codec'] = 'pcm'
+    pos = 12
+    byte_rate = 0
+    while pos + 8 <= size:
+        chunk_id, chunk_size = struct.unpack('<4sI', _read_at(f, pos, 8))
+        if chunk_id == b'fmt ':
+            fmt = _read_at(f, pos + 8, 16)
+            byte_rate = struct.unpack_from('<I', fmt, 8)[0]
+            meta['bitrate'] = byte_rate * 8 // 1000
+        elif chunk_id == b'data' and byte_rate:
+            meta['duration'] = chunk_size / byte_rate
+        elif chunk_id == b'LIST':
+            data = _read_at(f, pos + 8, min(chunk_size, 4096))
+            if data[:4] == b'INFO':
+                sub = 4
+                while sub + 8 <= len(data):
+                    sub_id, sub_size = struct.unpack_from('<4sI', data, sub)
+                    field = WAV_INFO_FIELDS.get(sub_id)
+                    if field:
+                        meta.setdefault(field, data[sub + 8:sub + 8 + sub_size].split(b'\x00')[0].decode('latin-1').strip())
+                    sub += 8 + sub_size + (sub_size & 1)
+        pos += 8 + chunk_size + (chunk_size & 1)
+
+
+def probe_audio_metadata(path: Path) -> dict:
+    """Tags, duration, bitrate and codec from the container headers of an audio file"""
+    meta = {}
+    try:
+        size = path.stat().st_size
+        with open(path, 'rb') as f:
+            head = f.read(AUDIO_PROBE_HEAD)
+            if head[:4] == b'fLaC':
+                _probe_flac(f, size, meta)
+            elif head[:4] == b'OggS':
+                _probe_ogg(f, size, head, meta)
+            elif head[4:8] == b'ftyp':
+                _probe_mp4(f, size, meta)
+            elif head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+                _probe_wav(f, size, meta)
+            elif head[:3] == b'ID3' or (len(head) > 1 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0):
+                _probe_mp3(f, size, head, meta)
+                _probe_id3v1(f, size, meta)
+    except (OSError, struct.error, ValueError, IndexError, KeyError) as e:
+        logger.warning(f"Could not read audio metadata from {path.name}: {e}")
+
+    if meta.get('duration') and not meta.get('bitrate'):
+        meta['bitrate'] = int(size * 8 / meta['duration'] / 1000)
+    if meta.get('duration') is not None:
+        meta['duration'] = round(meta['duration'], 3)
+    # Empty tag values aren't worth storing
+    return {key: value for key, value in meta.items() if value not in ('', None)}
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LibraryStore:
+    """Content-addressed song storage: blobs sharded by SHA-256, reference-counted by filename aliases"""
+
+    def __init__(self, db_path: Path, objects_dir: Path):
+        self.db_path = db_path
+        self.objects_dir = objects_dir
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        with self._lock:
+            if self._conn is not None:
+                return
+            self.objects_dir.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            # Audio metadata lives with the content so duplicates share it
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(blobs)")}
+            for column, definition in self.METADATA_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE blobs ADD COLUMN {column} {definition}")
+            # Every public filename (including pre-dedup uuid names) is an alias onto a blob
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS songs (
+                    filename TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL REFERENCES blobs (sha256),
+                    original_name TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS songs_created_at ON songs (created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS songs_original_name ON songs (original_name COLLATE NOCASE)")
+            conn.execute("CREATE INDEX IF NOT EXISTS songs_size ON songs (size)")
+            conn.execute("CREATE INDEX IF NOT EXISTS songs_sha256 ON songs (sha256)")
+            # 'version' is bumped on every change and backs the /library ETag
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+            # Last seen mtime of each shard directory, so startup only rescans what changed
+            conn.execute("CREATE TABLE IF NOT EXISTS scanned_dirs (path TEXT PRIMARY KEY, mtime REAL NOT NULL)")
+            self._conn = conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    METADATA_COLUMNS = {
+        'title': 'TEXT',
+        'artist': 'TEXT',
+        'album': 'TEXT',
+        'duration': 'REAL',
+        'bitrate': 'INTEGER',
+        'codec': 'TEXT',
+        'probed': 'INTEGER NOT NULL DEFAULT 0'
+    }
+    METADATA_FIELDS = ('title', 'artist', 'album', 'duration', 'bitrate', 'codec')
+
+    def blob_path(self, sha256: str, ext: str) -> Path:
+        return self.objects_dir / sha256[:2] / sha256[2:4] / f"{sha256}{ext}"
+
+    def _store_metadata(self, conn: sqlite3.Connection, sha256: str, metadata: dict):
+        conn.execute(
+            "UPDATE blobs SET title = ?, artist = ?, album = ?, duration = ?, bitrate = ?, codec = ?, probed = 1 "
+            "WHERE sha256 = ?",
+            tuple(metadata.get(field) for field in self.METADATA_FIELDS) + (sha256,)
+        )
+
+    def metadata(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT b.title, b.artist, b.album, b.duration, b.bitrate, b.codec "
+                "FROM songs s JOIN blobs b ON b.sha256 = s.sha256 WHERE s.filename = ?",
+                (filename,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {field: value for field, value in zip(self.METADATA_FIELDS, row) if value is not None}
+
+    def backfill_metadata(self) -> int:
+        """Probe blobs stored before metadata extraction existed"""
+        with self._lock:
+            pending = self._conn.execute("SELECT sha256, ext FROM blobs WHERE probed = 0").fetchall()
+        for sha256, ext in pending:
+            metadata = probe_audio_metadata(self.blob_path(sha256, ext))
+            with self._lock:
+                self._store_metadata(self._conn, sha256, metadata)
+                self._bump_version(self._conn)
+        return len(pending)
+
+    @staticmethod
+    def _bump_version(conn: sqlite3.Connection):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def version(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def add(self, source: Path, sha256: str, ext: str, filename: str, original_name: str,
+            size: int, created_at: Optional[float] = None) -> bool:
+        """Store source under its hash and alias it as filename; returns True if the content already existed.
+
+        source is always consumed: moved into the object store, or removed when it is a duplicate.
+        """
+        created_at = created_at or time.time()
+        with self._lock:
+            conn = self._conn
+            # IMMEDIATE takes the write lock up front so concurrent workers can't both create a blob
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT ext FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+                duplicate = row is not None and self.blob_path(sha256, row[0]).exists()
+                if duplicate:
+                    conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+                else:
+                    metadata = probe_audio_metadata(source)
+                    target = self.blob_path(sha256, ext)
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(source, target)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO blobs (sha256, ext, size, refcount, created_at) "
+                        "VALUES (?, ?, ?, COALESCE((SELECT refcount FROM blobs WHERE sha256 = ?), 0) + 1, ?)",
+                        (sha256, ext, size, sha256, created_at)
+                    )
+                    self._store_metadata(conn, sha256, metadata)
+                conn.execute(
+                    "INSERT INTO songs (filename, sha256, original_name, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (filename, sha256, original_name, size, created_at)
+                )
+                self._bump_version(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if duplicate:
+            source.unlink(missing_ok=True)
+        return duplicate
+
+    def resolve(self, filename: str) -> Optional[dict]:
+        """Blob path and validators (hash, size, mtime) behind a public filename"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT b.sha256, b.ext, b.size, b.created_at FROM songs s JOIN blobs b ON b.sha256 = s.sha256 "
+                "WHERE s.filename = ?",
+                (filename,)
+            ).fetchone()
+        if row is None:
+            return None
+        sha256, ext, size, created_at = row
+        return {
+            'path': self.blob_path(sha256, ext),
+            'sha256': sha256,
+            'ext': ext,
+            'size': size,
+            'modified': created_at
+        }
+
+    def remove(self, filename: str) -> Optional[bool]:
+        """Drop one reference; returns None if unknown, True if the blob itself was deleted"""
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT b.sha256, b.ext, b.refcount FROM songs s JOIN blobs b ON b.sha256 = s.sha256 "
+                    "WHERE s.filename = ?",
+                    (filename,)
+                ).fetchone()
+                if row is None:
+                    conn.execute("ROLLBACK")
+                    return None
+                sha256, ext, refcount = row
+                conn.execute("DELETE FROM songs WHERE filename = ?", (filename,))
+                if refcount <= 1:
+                    conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                    # Unlink under the write lock: once it is released, a re-upload of the same
+                    # content may move a new file into this path
+                    self.blob_path(sha256, ext).unlink(missing_ok=True)
+                else:
+                    conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+                self._bump_version(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return refcount <= 1
+
+    SORT_COLUMNS = {
+        'modified': 's.created_at',
+        'name': 's.original_name COLLATE NOCASE',
+        'size': 's.size',
+        'duration': 'b.duration'
+    }
+
+    def list_songs(self, sort: str = 'modified', descending: bool = True,
+                   limit: Optional[int] = None, offset: int = 0) -> tuple:
+        """One page of songs plus the total count and the index version it was read at"""
+        order = f"{self.SORT_COLUMNS[sort]} {'DESC' if descending else 'ASC'}, s.filename"
+        with self._lock:
+            version = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            total = self._conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT s.filename, s.original_name, s.size, s.created_at, "
+                "b.title, b.artist, b.album, b.duration, b.bitrate, b.codec "
+                f"FROM songs s JOIN blobs b ON b.sha256 = s.sha256 ORDER BY {order} LIMIT ? OFFSET ?",
+                (limit if limit is not None else -1, offset)
+            ).fetchall()
+        songs = [
+            dict(
+                filename=row[0],
+                original_name=row[1],
+                size=row[2],
+                created_at=row[3],
+                **dict(zip(self.METADATA_FIELDS, row[4:]))
+            )
+            for row in rows
+        ]
+        return songs, total, version
+
+    def reconcile(self) -> int:
+        """Bring the index in line with objects/, rescanning only shard dirs whose mtime changed"""
+        changes = 0
+        with self._lock:
+            seen = dict(self._conn.execute("SELECT path, mtime FROM scanned_dirs").fetchall())
+        for top in self.objects_dir.iterdir():
+            if not top.is_dir():
+                continue
+            for shard in top.iterdir():
+                if not shard.is_dir():
+                    continue
+                key = str(shard.relative_to(self.objects_dir))
+                mtime = shard.stat().st_mtime
+                if seen.get(key) == mtime:
+                    continue
+                changes += self._reconcile_shard(shard, key.replace(os.sep, ''))
+                with self._lock:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO scanned_dirs (path, mtime) VALUES (?, ?)", (key, mtime)
+                    )
+        return changes
+
+    def _reconcile_shard(self, shard: Path, prefix: str) -> int:
+        on_disk = {}
+        for file_path in shard.iterdir():
+            if file_path.is_file() and file_path.suffix.lower() in ALLOWED_EXTENSIONS:
+                on_disk[file_path.stem] = file_path
+        changes = 0
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                indexed = dict(conn.execute(
+                    "SELECT sha256, ext FROM blobs WHERE sha256 >= ? AND sha256 < ?",
+                    (prefix, prefix + 'g')
+                ).fetchall())
+                # Blobs whose file vanished take their aliases with them
+                for sha256 in indexed.keys() - on_disk.keys():
+                    conn.execute("DELETE FROM songs WHERE sha256 = ?", (sha256,))
+                    conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                    changes += 1
+                # Files without an index row are re-registered under their hash name
+                for sha256 in on_disk.keys() - indexed.keys():
+                    file_path = on_disk[sha256]
+                    stat = file_path.stat()
+                    ext = file_path.suffix.lower()
+                    conn.execute(
+                        "INSERT INTO blobs (sha256, ext, size, refcount, created_at) VALUES (?, ?, ?, 1, ?)",
+                        (sha256, ext, stat.st_size, stat.st_mtime)
+                    )
+                    self._store_metadata(conn, sha256, probe_audio_metadata(file_path))
+                    conn.execute(
+                        "INSERT OR IGNORE INTO songs (filename, sha256, original_name, size, created_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (f"{sha256}{ext}", sha256, sha256, stat.st_size, stat.st_mtime)
+                    )
+                    changes += 1
+                if changes:
+                    self._bump_version(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return changes
+
+    def migrate_flat_files(self, upload_dir: Path) -> int:
+        """Move pre-dedup uploads (uploads/<uuid>.<ext>) into the object store, keeping their names as aliases"""
+        migrated = 0
+        for file_path in upload_dir.iterdir():
+            if not file_path.is_file() or file_path.suffix.lower() not in ALLOWED_EXTENSIONS:
+                continue
+            try:
+                stat = file_path.stat()
+                self.add(
+                    file_path,
+                    hash_file(file_path),
+                    file_path.suffix.lower(),
+                    file_path.name,
+                    file_path.stem,
+                    stat.st_size,
+                    created_at=stat.st_mtime
+                )
+                migrated += 1
+            except sqlite3.IntegrityError:
+                # Alias already indexed (e.g. another worker migrated it first)
+                file_path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                # Another worker moved it into the object store between listing and hashing
+                continue
+        return migrated
+
+
+library = LibraryStore(LIBRARY_DB_PATH, OBJECTS_DIR)
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[float] = None) -> bool:
+    """Evaluate If-None-Match / If-Modified-Since against a resource's validators"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison is what RFC 9110 asks for on If-None-Match
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in candidates or etag in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
 # Serve uploaded songs
-@app.get("/songs/{filename}")
-async def serve_song(filename: str):
-    """Serve uploaded audio files with proper headers"""
-    file_path = UPLOAD_DIR / filename
+@app.api_route("/songs/{filename}", methods=["GET", "HEAD"])
+async def serve_song(filename: str, request: Request):
+    """Serve uploaded audio files with validators, conditional GETs and byte ranges"""
+    entry = await asyncio.to_thread(library.resolve, filename)
     
-    if not file_path.exists():
+    if entry is None:
         raise HTTPException(status_code=404, detail="File not found")
     
     # Check if file extension is allowed
-    if file_path.suffix.lower() not in ALLOWED_EXTENSIONS:
+    if entry['ext'] not in ALLOWED_EXTENSIONS:
         raise HTTPException(status_code=400, detail="File type not supported")
     
-    return FileResponse(
-        path=file_path,
-        media_type="audio/mpeg",
-        headers={
-            "Accept-Ranges": "bytes",
-            "Cache-Control": "public, max-age=3600",
-            "Access-Control-Allow-Origin": "*"
-        }
-    )
-
-@app.post("/upload", response_model=UploadResponse)
-async def upload_audio(file: UploadFile = File(...)):
-    """Upload audio file to server with enhanced validation"""
+    # Content hashes make a strong ETag that survives re-uploads and restarts
+    etag = f'"{entry["sha256"]}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(entry['modified'], usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=3600",
+        "Access-Control-Allow-Origin": "*"
+    }
     
-    # Validate file extension
-    file_ext = Path(file.filename).suffix.lower()
-    if file_ext not in ALLOWED_EXTENSIONS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File type {file_ext} not supported. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
-        )
+    if is_not_modified(request, etag, entry['modified']):
+        return Response(status_code=304, headers=headers)
     
-    # Check file size
-    content = await file.read()
-    file_size = len(content)
+    try:
+        stat_result = await asyncio.to_thread(os.stat, entry['path'])
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
     
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large. Maximum size: {MAX_FILE_SIZE // (1024*1024)}MB"
+    # FileResponse handles Range, multi-range (multipart/byteranges) and If-Range
+    # against the ETag/Last-Modified headers set above
+    return CountedFileResponse(
+        path=entry['path'],
+        media_type=AUDIO_MIME_TYPES.get(entry['ext'], "application/octet-stream"),
+        headers=headers,
+        stat_result=stat_result,
+        counter=song_bytes_served
+    )
+
+def file_too_large_error() -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=f"File too large. Maximum size: {MAX_FILE_SIZE // (1024*1024)}MB"
+    )
+
+
+class StreamingUpload:
+    """Receive the `file` field of a multipart body straight into a temp file in UPLOAD_DIR"""
+
+    def __init__(self, field_name: str = "file"):
+        self.field_name = field_name
+        self.filename: Optional[str] = None
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.temp_path: Optional[Path] = None
+        self._file = None
+        self._buffer = bytearray()
+        self._in_file_part = False
+        self._file_done = False
+        self._disposition = b""
+        self._header_name = b""
+        self._header_value = b""
+        self._pending: List[bytes] = []  # Data handed over by the sync parser callbacks
+
+    # python-multipart callbacks (synchronous, so they only record state)
+    def _on_part_begin(self):
+        self._disposition = b""
+        self._in_file_part = False
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if name == self.field_name and b"filename" in options and self.filename is None:
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self._in_file_part = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file_part:
+            self._pending.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file_part:
+            self._in_file_part = False
+            self._file_done = True
+
+    async def _open(self):
+        """Validate the filename and open the temp file once the part headers arrive"""
+        file_ext = Path(self.filename).suffix.lower()
+        if file_ext not in ALLOWED_EXTENSIONS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"File type {file_ext} not supported. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+            )
+        self.temp_path = UPLOAD_DIR / f".upload-{uuid.uuid4().hex}.part"
+        self._file = await aiofiles.open(self.temp_path, 'wb')
+
+    async def _consume(self, flush: bool = False):
+        if self.filename is not None and self._file is None:
+            await self._open()
+
+        for data in self._pending:
+            self.size += len(data)
+            if self.size > MAX_FILE_SIZE:
+                # Abort as soon as the limit is crossed instead of reading the rest
+                raise file_too_large_error()
+            self.hasher.update(data)
+            self._buffer += data
+        self._pending.clear()
+
+        if self._buffer and (flush or len(self._buffer) >= UPLOAD_CHUNK_SIZE):
+            await self._file.write(bytes(self._buffer))
+            self._buffer.clear()
+
+    async def receive(self, request: Request):
+        """Parse the request body, streaming the file part to disk"""
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + MULTIPART_OVERHEAD:
+            raise file_too_large_error()
+
+        parser = multipart.MultipartParser(params[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+        async for chunk in request.stream():
+            parser.write(chunk)
+            await self._consume()
+        parser.finalize()
+        await self._consume(flush=True)
+
+        if self.filename is None or not self._file_done:
+            raise HTTPException(status_code=400, detail="No file provided")
+
+    async def store(self, filename: str) -> bool:
+        """Hand the finished temp file to the content-addressed library; returns True for duplicates"""
+        await self._file.close()
+        self._file = None
+        duplicate = await asyncio.to_thread(
+            library.add,
+            self.temp_path,
+            self.hasher.hexdigest(),
+            Path(self.filename).suffix.lower(),
+            filename,
+            self.filename,
+            self.size
         )
-    
-    # Generate unique filename
-    unique_filename = f"{uuid.uuid4()}{file_ext}"
-    file_path = UPLOAD_DIR / unique_filename
+        self.temp_path = None
+        return duplicate
+
+    async def discard(self):
+        if self._file is not None:
+            await self._file.close()
+            self._file = None
+        if self.temp_path is not None:
+            await asyncio.to_thread(self.temp_path.unlink, missing_ok=True)
+            self.temp_path = None
+
+
+@app.post(
+    "/upload",
+    response_model=UploadResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                        "required": ["file"]
+                    }
+                }
+            }
+        }
+    }
+)
+async def upload_audio(request: Request):
+    """Upload audio file to server, streaming it to disk in chunks"""
+    upload = StreamingUpload()
+    started = time.perf_counter()
     
     try:
-        # Save file
-        async with aiofiles.open(file_path, 'wb') as f:
-            await f.write(content)
+        await upload.receive(request)
+        upload_bytes.inc(upload.size)
+        upload_throughput.observe(upload.size / max(time.perf_counter() - started, 1e-6))
+        
+        # Generate unique filename (an alias onto the content-addressed blob)
+        unique_filename = f"{uuid.uuid4()}{Path(upload.filename).suffix.lower()}"
+        duplicate = await upload.store(unique_filename)
+        metadata = await asyncio.to_thread(library.metadata, unique_filename)
         
-        logger.info(f"File uploaded successfully: {unique_filename}")
+        if duplicate:
+            logger.info(f"Duplicate upload stored as reference: {unique_filename} -> {upload.hasher.hexdigest()}")
+        else:
+            logger.info(f"File uploaded successfully: {unique_filename} ({upload.size} bytes)")
         
         return UploadResponse(
             filename=unique_filename,
-            original_name=file.filename,
-            size=file_size,
-            message="File uploaded successfully"
+            original_name=upload.filename,
+            size=upload.size,
+            message="File already stored, added a reference" if duplicate else "File uploaded successfully",
+            sha256=upload.hasher.hexdigest(),
+            duplicate=duplicate,
+            metadata=metadata
         )
     
+    except HTTPException:
+        raise
+    except ClientDisconnect:
+        logger.warning("Client disconnected during upload")
+        raise HTTPException(status_code=400, detail="Upload interrupted")
     except Exception as e:
         logger.error(f"Upload failed: {str(e)}")
         raise HTTPException(status_code=500, detail="Upload failed")
+    finally:
+        await upload.discard()
 
-@app.get("/search", response_model=SearchResponse)
-async def search_youtube(q: str = Query(..., description="Search query")):
-    """Search YouTube for videos with enhanced error handling"""
+def normalize_search_query(q: str) -> str:
+    """Cache key for a query: Unicode-normalized, case-folded, whitespace collapsed"""
+    return " ".join(unicodedata.normalize("NFKC", q).casefold().split())
+
+
+def normalize_search_results(raw: Optional[dict]) -> List[dict]:
+    """SearchResult dicts from a raw youtube-search-python page, without Shorts and zero-length items"""
+    if not raw or 'result' not in raw:
+        return []
     
-    if not YOUTUBE_SEARCH_AVAILABLE:
-        raise HTTPException(
-            status_code=503,
-            detail="YouTube search not available. Please install youtube-search-python"
-        )
+    search_results = []
+    
+    for video in raw['result']:
+        try:
+            # Skip shorts and very short videos
+            duration = video.get('duration', '0:00')
+            if 'Shorts' in video.get('title', '') or duration in ['0:00', None]:
+                continue
+            
+            search_results.append({
+                'id': video['id'],
+                'title': video['title'],
+                'channel': video['channel']['name'],
+                'duration': duration,
+                'thumbnail': video['thumbnails'][0]['url'] if video.get('thumbnails') else '',
+                'url': video['link']
+            })
+        except KeyError as e:
+            logger.warning(f"Skipping video due to missing field: {e}")
+            continue
+    
+    return search_results
+
+
+def start_search(q: str) -> tuple:
+    """Blocking first-page YouTube search - run it through search_pool"""
+    # Search YouTube with additional parameters
+    videos_search = VideosSearch(q, limit=20, region='US', language='en')
+    return videos_search, normalize_search_results(videos_search.result())
+
+
+def continue_search(videos_search) -> tuple:
+    """Blocking fetch of the next upstream page via the search's continuation token"""
+    if not videos_search.next():
+        return [], False
+    return normalize_search_results(videos_search.result()), bool(videos_search.continuationKey)
+
+
+def add_search_results(session: dict, results: List[dict]):
+    # Continuation pages occasionally repeat videos
+    for result in results:
+        if result['id'] not in session['seen']:
+            session['seen'].add(result['id'])
+            session['results'].append(result)
+
+
+async def create_search_session(key: str, q: str) -> dict:
+    """Run the first search page and cache the continuation state under the normalized query"""
+    videos_search, results = await search_pool.run(start_search, q)
+    session = {
+        'search': videos_search,
+        'results': [],
+        'seen': set(),
+        'exhausted': not videos_search.continuationKey,
+        'lock': asyncio.Lock()
+    }
+    add_search_results(session, results)
+    search_cache.set(key, session, search_cache.default_ttl)
+    return session
+
+
+async def search_page(key: str, q: str, offset: int, limit: int) -> tuple:
+    """Results [offset, offset + limit) for a query, fetching continuation pages only as needed"""
+    session = search_cache.get(key)
+    if session is None:
+        # Identical queries already in flight share the upstream call
+        session = await search_flights.do(key, create_search_session, key, q)
+    
+    wanted = offset + limit
+    if len(session['results']) < wanted and not session['exhausted']:
+        async with session['lock']:
+            upstream_calls = 0
+            while (len(session['results']) < wanted and not session['exhausted']
+                   and upstream_calls < SEARCH_MAX_UPSTREAM_CALLS):
+                results, more = await search_pool.run(continue_search, session['search'])
+                add_search_results(session, results)
+                session['exhausted'] = not more
+                upstream_calls += 1
+            # Re-insert so the cache accounts for the grown result list
+            search_cache.set(key, session, search_cache.default_ttl)
+    
+    page = session['results'][offset:wanted]
+    if not page and not session['exhausted']:
+        # Rebuilding an evicted session ran out of upstream calls before reaching the cursor;
+        # the pages fetched so far stay cached, so the same cursor gets further next time
+        raise HTTPException(
+            status_code=503,
+            detail="Search results are still loading, retry the same cursor",
+            headers={"Retry-After": "1"}
+        )
+    has_more = len(session['results']) > wanted or not session['exhausted']
+    return page, has_more
+
+
+def encode_search_cursor(key: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([key, offset]).encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> tuple:
+    try:
+        key, offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(key, str) or not isinstance(offset, int) or offset < 0:
+            raise ValueError(cursor)
+        return key, offset
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid search cursor")
+
+
+@app.get("/search", response_model=SearchResponse)
+async def search_youtube(
+    q: str = Query(..., description="Search query"),
+    limit: int = Query(20, ge=1, le=50, description="Results per page"),
+    cursor: Optional[str] = Query(None, description="Opaque next_cursor from a previous page")
+):
+    """Search YouTube for videos with enhanced error handling"""
+    
+    if not YOUTUBE_SEARCH_AVAILABLE:
+        raise HTTPException(
+            status_code=503,
+            detail="YouTube search not available. Please install youtube-search-python"
+        )
     
     if not q.strip():
         raise HTTPException(status_code=400, detail="Search query cannot be empty")
     
+    key = normalize_search_query(q)
+    offset = 0
+    if cursor:
+        cursor_key, offset = decode_search_cursor(cursor)
+        if cursor_key != key:
+            raise HTTPException(status_code=400, detail="Search cursor does not match the query")
+    
     try:
-        logger.info(f"Searching for: {q}")
-        
-        # Search YouTube with additional parameters
-        videos_search = VideosSearch(q, limit=20, region='US', language='en')
-        results = videos_search.result()
+        logger.info(f"Searching for: {q} (offset {offset})")
         
-        if not results or 'result' not in results:
-            logger.warning(f"No results found for query: {q}")
-            return SearchResponse(results=[], total=0)
-        
-        search_results = []
-        
-        for video in results['result']:
-            try:
-                # Skip shorts and very short videos
-                duration = video.get('duration', '0:00')
-                if 'Shorts' in video.get('title', '') or duration in ['0:00', None]:
-                    continue
-                
-                search_result = SearchResult(
-                    id=video['id'],
-                    title=video['title'],
-                    channel=video['channel']['name'],
-                    duration=duration,
-                    thumbnail=video['thumbnails'][0]['url'] if video.get('thumbnails') else '',
-                    url=video['link']
-                )
-                search_results.append(search_result)
-            except KeyError as e:
-                logger.warning(f"Skipping video due to missing field: {e}")
-                continue
+        results, has_more = await search_page(key, q, offset, limit)
         
-        logger.info(f"Found {len(search_results)} valid results")
+        logger.info(f"Found {len(results)} valid results")
         return SearchResponse(
-            results=search_results,
-            total=len(search_results)
+            results=results,
+            total=len(results),
+            next_cursor=encode_search_cursor(key, offset + len(results)) if has_more and results else None
         )
     
+    except HTTPException:
+        raise
+    except WorkerPoolSaturated:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many searches in progress, please retry shortly",
+            headers={"Retry-After": str(EXTRACTION_RETRY_AFTER)}
+        )
+    except asyncio.TimeoutError:
+        logger.error(f"Search timed out for: {q}")
+        raise HTTPException(status_code=504, detail="Search timed out")
     except Exception as e:
         logger.error(f"Search failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
 
-def get_yt_dlp_options():
+def stream_url_expiry(url: str) -> Optional[float]:
+    """Unix timestamp from the expire= parameter of a googlevideo URL, if present"""
+    try:
+        parsed = urlparse(url)
+        expire = parse_qs(parsed.query).get('expire')
+        if expire:
+            return float(expire[0])
+        # Some manifests carry it as a path segment: /expire/<ts>/
+        parts = parsed.path.split('/')
+        if 'expire' in parts:
+            return float(parts[parts.index('expire') + 1])
+    except (ValueError, IndexError):
+        pass
+    return None
+
+
+class TTLCache:
+    """LRU cache with per-entry TTLs and an entry/size budget"""
+
+    def __init__(self, max_entries: int, max_bytes: int, default_ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (deadline, size, data)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _entry_size(data: dict) -> int:
+        return 64 + sum(len(str(k)) + len(str(v)) for k, v in data.items())
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, key: str, data: dict, ttl: float):
+        if ttl <= 0:
+            return
+        if key in self._entries:
+            self._remove(key)
+        size = self._entry_size(data)
+        self._entries[key] = (time.monotonic() + ttl, size, data)
+        self.bytes += size
+        self._evict()
+
+    def invalidate(self, key: str) -> bool:
+        if key in self._entries:
+            self._remove(key)
+            return True
+        return False
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def _evict(self):
+        now = time.monotonic()
+        # Drop an expired entry sitting at the LRU end first, then enforce the bounds
+        while self._entries:
+            oldest_key, (deadline, _, _) = next(iter(self._entries.items()))
+            if deadline <= now:
+                self._remove(oldest_key)
+                self.expirations += 1
+            elif len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(oldest_key)
+                self.evictions += 1
+            else:
+                break
+
+    def peek(self, key: str) -> bool:
+        """Whether a live entry exists, without touching LRU order or counters"""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class StreamCache(TTLCache):
+    """TTLCache of resolved stream URLs that expires entries ahead of the googlevideo deadline"""
+
+    def __init__(self, max_entries: int, max_bytes: int, safety_margin: float, default_ttl: float):
+        super().__init__(max_entries, max_bytes, default_ttl)
+        self.safety_margin = safety_margin
+
+    def ttl_for(self, url: str) -> float:
+        """Seconds an extracted URL may be served, based on its expire= parameter"""
+        expire = stream_url_expiry(url)
+        if expire is None:
+            return self.default_ttl
+        return expire - time.time() - self.safety_margin
+
+
+class PersistentStreamCache:
+    """SQLite-backed extraction cache in CACHE_DIR, shared by workers on the same host"""
+
+    PURGE_EVERY = 500  # Writes between sweeps of expired rows
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def open(self):
+        """Open the database (called from startup, not at import)"""
+        with self._lock:
+            if self._conn is not None:
+                return
+            conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False)
+            # WAL lets several uvicorn workers read while one writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS streams (
+                    video_id TEXT PRIMARY KEY,
+                    stream_url TEXT NOT NULL,
+                    title TEXT,
+                    duration TEXT,
+                    formats TEXT,
+                    expires_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS streams_expires_at ON streams (expires_at)")
+            conn.commit()
+            self._conn = conn
+        self.purge_expired()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, video_id: str) -> Optional[dict]:
+        """Unexpired cached entry for a video, with 'expires_at' as a unix timestamp"""
+        with self._lock:
+            if self._conn is None:
+                return None
+            row = self._conn.execute(
+                "SELECT stream_url, title, duration, formats, expires_at FROM streams "
+                "WHERE video_id = ? AND expires_at > ?",
+                (video_id, time.time())
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {
+            'stream_url': row[0],
+            'title': row[1],
+            'duration': row[2],
+            'formats': json.loads(row[3]) if row[3] else [],
+            'expires_at': row[4]
+        }
+
+    def put(self, video_id: str, data: dict, formats: List[dict], expires_at: float):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO streams "
+                "(video_id, stream_url, title, duration, formats, expires_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    video_id,
+                    data['stream_url'],
+                    data.get('title'),
+                    data.get('duration'),
+                    json.dumps(formats, separators=(',', ':')),
+                    expires_at,
+                    time.time()
+                )
+            )
+            self._conn.commit()
+            self.writes += 1
+            self._writes += 1
+            purge = self._writes >= self.PURGE_EVERY
+            if purge:
+                self._writes = 0
+        if purge:
+            self.purge_expired()
+
+    def delete(self, video_id: str):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.execute("DELETE FROM streams WHERE video_id = ?", (video_id,))
+            self._conn.commit()
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            if self._conn is None:
+                return 0
+            cursor = self._conn.execute("DELETE FROM streams WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self._conn is not None,
+            'path': str(self.path),
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes
+        }
+
+
+def compact_formats(formats: List[dict]) -> List[dict]:
+    """Format descriptors worth persisting (without the large per-format URLs)"""
+    return [
+        {
+            'format_id': fmt.get('format_id'),
+            'ext': fmt.get('ext'),
+            'acodec': fmt.get('acodec'),
+            'vcodec': fmt.get('vcodec'),
+            'abr': fmt.get('abr')
+        }
+        for fmt in formats
+    ]
+
+
+# Cache for stream URLs to avoid repeated yt-dlp calls
+persistent_cache = PersistentStreamCache(PERSISTENT_CACHE_PATH)
+stream_cache = StreamCache(
+    STREAM_CACHE_MAX_ENTRIES,
+    STREAM_CACHE_MAX_BYTES,
+    STREAM_CACHE_SAFETY_MARGIN,
+    CACHE_DURATION.total_seconds()
+)
+
+
+def get_yt_dlp_options(fast: bool = False):
     """Get optimized yt-dlp options"""
-    return {
+    options = {
         'format': 'bestaudio[ext=m4a]/bestaudio/best',
         'quiet': True,
         'no_warnings': True,
@@ -329,9 +2081,273 @@ def get_yt_dlp_options():
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
     }
+    if fast:
+        # The audio formats we pick come from the player response; the manifests only add round-trips
+        options['extractor_args'] = {'youtube': {'skip': ['hls', 'dash', 'translated_subs']}}
+    return options
+
+def select_audio_format(info: dict) -> Optional[dict]:
+    """Pick the stream to play in a single pass over the formats"""
+    # yt-dlp already applied our 'format' selector; use its pick when it is audio-only
+    if info.get('url') and info.get('acodec') != 'none' and info.get('vcodec') == 'none':
+        return info
+
+    best = None
+    best_rank = len(AUDIO_FORMAT_PRIORITIES)
+    mixed = None
+    for fmt in info.get('formats') or ():
+        if fmt.get('acodec') == 'none':
+            continue
+        if mixed is None:
+            mixed = fmt
+        if fmt.get('vcodec') == 'none':
+            rank = AUDIO_FORMAT_PRIORITIES.get(fmt.get('ext'), best_rank)
+            if rank < best_rank:
+                best, best_rank = fmt, rank
+                if rank == 0:
+                    break
+    return best or mixed
+
+class WorkerPoolSaturated(Exception):
+    """Raised when a worker pool has no free worker or queue slot"""
+
+
+class WorkerPool:
+    """Bounded thread pool that keeps blocking calls (yt-dlp, search) off the event loop"""
+
+    def __init__(self, name: str, max_workers: int, max_queued: int, timeout: float,
+                 latency: Optional[Histogram] = None):
+        self.name = name
+        self.latency = latency  # Observes queue wait plus run time of every accepted job
+        self.max_workers = max_workers
+        self.max_jobs = max_workers + max_queued
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._jobs = 0  # Submitted jobs whose thread work has not finished yet
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _job_done(self, _future):
+        with self._lock:
+            self._jobs -= 1
+            self.completed += 1
+
+    async def run(self, func, *args, **kwargs):
+        """Run func in a worker thread, enforcing the queue limit and job timeout"""
+        with self._lock:
+            # Jobs that timed out keep their slot until the thread actually returns,
+            # so a hung extraction still counts against the limit
+            if self._jobs >= self.max_jobs:
+                self.rejected += 1
+                raise WorkerPoolSaturated()
+            self._jobs += 1
+
+        started = time.perf_counter()
+        future = self._executor.submit(functools.partial(func, *args, **kwargs))
+        future.add_done_callback(self._job_done)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise
+        finally:
+            if self.latency is not None:
+                self.latency.observe(time.perf_counter() - started)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._jobs
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = self._jobs
+        return {
+            'workers': self.max_workers,
+            'max_jobs': self.max_jobs,
+            'in_flight': jobs,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+extraction_pool = WorkerPool("yt-dlp", EXTRACTION_WORKERS, EXTRACTION_QUEUE_LIMIT, EXTRACTION_TIMEOUT, extraction_seconds)
+search_pool = WorkerPool("search", SEARCH_WORKERS, SEARCH_QUEUE_LIMIT, SEARCH_TIMEOUT, search_upstream_seconds)
+search_cache = TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL)
+
+
+def extraction_busy_error() -> HTTPException:
+    """503 returned when the extraction pool is saturated"""
+    return HTTPException(
+        status_code=503,
+        detail="Too many stream extractions in progress, please retry shortly",
+        headers={"Retry-After": str(EXTRACTION_RETRY_AFTER)}
+    )
+
+
+class ExtractorCache:
+    """One long-lived YoutubeDL per worker thread, keeping extractor state, player JS and cookies warm"""
+
+    def __init__(self, fast: bool, recycle_after: int):
+        self.fast = fast
+        self.recycle_after = recycle_after
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances: Set = set()
+        self.created = 0
+        self.reused = 0
+
+    def get(self):
+        local = self._local
+        ydl = getattr(local, 'ydl', None)
+        if ydl is not None and local.uses >= self.recycle_after:
+            self._discard(ydl)
+            ydl = None
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(get_yt_dlp_options(fast=self.fast))
+            local.ydl = ydl
+            local.uses = 0
+            with self._lock:
+                self._instances.add(ydl)
+                self.created += 1
+        else:
+            with self._lock:
+                self.reused += 1
+        local.uses += 1
+        return ydl
+
+    def _discard(self, ydl):
+        with self._lock:
+            self._instances.discard(ydl)
+        try:
+            ydl.close()
+        except Exception as e:
+            logger.warning(f"Closing YoutubeDL failed: {e}")
+
+    def close(self):
+        with self._lock:
+            instances = list(self._instances)
+            self._instances.clear()
+        for ydl in instances:
+            try:
+                ydl.close()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'fast_path': self.fast,
+                'instances': len(self._instances),
+                'created': self.created,
+                'reused': self.reused
+            }
+
+
+extractors = ExtractorCache(EXTRACTION_FAST_PATH, EXTRACTOR_RECYCLE_AFTER)
+
+
+def extract_video_info(video_id: str) -> Optional[dict]:
+    """Blocking yt-dlp metadata extraction - run it through extraction_pool"""
+    video_url = f"https://www.youtube.com/watch?v={video_id}"
+    return extractors.get().extract_info(video_url, download=False)
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key onto one in-flight task"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.flights = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, func, *args, **kwargs):
+        """Await func(*args, **kwargs), joining an identical call that is already running"""
+        task = self._inflight.get(key)
+        if task is None:
+            self.flights += 1
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(functools.partial(self._finish, key))
+        else:
+            self.coalesced += 1
+            self._waiters[key] += 1
+
+        # Shield so one caller disconnecting doesn't cancel the shared work
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            waiters = self._waiters.pop(key, 0)
+            if waiters:
+                logger.info(f"{self.name} for {key} served {waiters} coalesced caller(s)")
+        if not task.cancelled():
+            # Mark the exception as retrieved when nobody is left awaiting it
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._inflight),
+            'flights': self.flights,
+            'coalesced': self.coalesced
+        }
+
+
+# Separate flights for raw yt-dlp info (shared with /debug) and full stream resolution
+info_flights = SingleFlight("Extraction")
+stream_flights = SingleFlight("Stream resolution")
+search_flights = SingleFlight("Search")
+
+
+async def fetch_video_info(video_id: str) -> Optional[dict]:
+    """Extract video info in the worker pool, sharing in-flight extractions per video"""
+    return await info_flights.do(video_id, extraction_pool.run, extract_video_info, video_id)
+
+# Shared pooled HTTP client for upstream requests (opened on startup)
+http_client: Optional[httpx.AsyncClient] = None
+background_tasks: Set[asyncio.Task] = set()
+validation_stats = {'checked': 0, 'dead': 0, 'errors': 0}
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """Start a fire-and-forget task and keep a reference until it finishes"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def validate_stream_url(video_id: str, url: str):
+    """Probe a freshly extracted stream URL and drop it from the caches if it is dead"""
+    try:
+        response = await http_client.head(url, timeout=STREAM_VALIDATION_TIMEOUT)
+        validation_stats['checked'] += 1
+        if response.status_code >= 400:
+            validation_stats['dead'] += 1
+            logger.warning(f"Stream URL for {video_id} returned status {response.status_code}, marking for re-extraction")
+            stream_cache.invalidate(video_id)
+            await asyncio.to_thread(persistent_cache.delete, video_id)
+    except httpx.HTTPError as e:
+        validation_stats['errors'] += 1
+        logger.warning(f"Could not verify stream URL for {video_id}: {e}")
+
+
+def schedule_stream_validation(video_id: str, url: str):
+    if STREAM_VALIDATION_ENABLED and http_client is not None:
+        spawn_background(validate_stream_url(video_id, url))
 
 @app.get("/play/{video_id}")
-async def get_stream_url(video_id: str):
+async def get_stream_url(video_id: str, request: Request):
     """Get streamable URL for a YouTube video with caching and fallbacks"""
     
     if not YT_DLP_AVAILABLE:
@@ -341,139 +2357,150 @@ async def get_stream_url(video_id: str):
             ["Install yt-dlp: pip install yt-dlp", "Try uploading local files instead"]
         )
     
+    # Hot tracks are served from a local copy, skipping yt-dlp and YouTube entirely
+    local = audio_cache.get(video_id)
+    if local is not None:
+        logger.info(f"Returning local copy for {video_id}")
+        return PlayResponse(
+            stream_url=cached_stream_url(video_id, request),
+            title=local['title'],
+            duration=local['duration']
+        )
+    
+    result = await lookup_stream(video_id)
+    if isinstance(result, PlayResponse):
+        audio_cache.record_play(video_id, result)
+    return result
+
+async def lookup_stream(video_id: str):
+    """Upstream stream URL for a video from the cache or a (coalesced) resolution"""
+    prefetcher.claim(video_id)
+    
     # Check cache first
-    cache_key = f"{video_id}_{datetime.now().strftime('%Y%m%d%H')}"
-    if cache_key in stream_cache:
-        cached_data = stream_cache[cache_key]
-        if datetime.now() - cached_data['timestamp'] < CACHE_DURATION:
-            logger.info(f"Returning cached URL for {video_id}")
-            return PlayResponse(**cached_data['data'])
+    cached_data = stream_cache.get(video_id)
+    if cached_data is not None:
+        logger.info(f"Returning cached URL for {video_id}")
+        return PlayResponse(**cached_data)
     
+    # Concurrent misses for the same video share a single resolution
+    return await stream_flights.do(video_id, resolve_stream_url, video_id)
+
+async def resolve_stream_url(video_id: str):
+    """Extract, pick the audio format and cache the stream URL for a video"""
     try:
-        logger.info(f"Extracting stream URL for video: {video_id}")
+        # A previous process (or another worker) may already have resolved it
+        stored = await asyncio.to_thread(persistent_cache.get, video_id)
+        if stored is not None:
+            play_response = PlayResponse(
+                stream_url=stored['stream_url'],
+                title=stored['title'],
+                duration=stored['duration']
+            )
+            stream_cache.set(video_id, play_response.dict(), stored['expires_at'] - time.time())
+            logger.info(f"Returning persisted URL for {video_id}")
+            return play_response
         
-        ydl_opts = get_yt_dlp_options()
+        logger.info(f"Extracting stream URL for video: {video_id}")
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            video_url = f"https://www.youtube.com/watch?v={video_id}"
-            
-            try:
-                # Extract info
-                info = ydl.extract_info(video_url, download=False)
-            except yt_dlp.utils.DownloadError as e:
-                logger.error(f"yt-dlp download error for {video_id}: {str(e)}")
-                error_msg = str(e).lower()
-                
-                if "403" in error_msg or "forbidden" in error_msg:
-                    return create_error_response(
-                        "Access Forbidden",
-                        "This video is currently blocked by YouTube",
-                        [
-                            "Try a different video",
-                            "This is a temporary YouTube restriction",
-                            "The video may be geo-blocked"
-                        ]
-                    )
-                elif "404" in error_msg or "not found" in error_msg:
-                    return create_error_response(
-                        "Video Not Found",
-                        "This video is not available",
-                        [
-                            "The video may have been deleted",
-                            "Check if the video ID is correct",
-                            "Try searching for the song again"
-                        ]
-                    )
-                else:
-                    return create_error_response(
-                        "Extraction Failed",
-                        f"Could not extract video: {str(e)[:100]}",
-                        [
-                            "Try a different video",
-                            "Check your internet connection",
-                            "YouTube may be blocking requests"
-                        ]
-                    )
+        try:
+            # Extract info in the worker pool so the event loop stays responsive
+            info = await fetch_video_info(video_id)
+        except WorkerPoolSaturated:
+            logger.warning(f"Extraction pool saturated, rejecting {video_id}")
+            raise extraction_busy_error()
+        except asyncio.TimeoutError:
+            logger.error(f"yt-dlp extraction timed out for {video_id}")
+            return create_error_response(
+                "Extraction Timed Out",
+                f"Extraction took longer than {EXTRACTION_TIMEOUT:.0f}s",
+                [
+                    "Try again in a few moments",
+                    "YouTube may be slow to respond"
+                ]
+            )
+        except yt_dlp.utils.DownloadError as e:
+            logger.error(f"yt-dlp download error for {video_id}: {str(e)}")
+            error_msg = str(e).lower()
             
-            if not info:
+            if "403" in error_msg or "forbidden" in error_msg:
+                return create_error_response(
+                    "Access Forbidden",
+                    "This video is currently blocked by YouTube",
+                    [
+                        "Try a different video",
+                        "This is a temporary YouTube restriction",
+                        "The video may be geo-blocked"
+                    ]
+                )
+            elif "404" in error_msg or "not found" in error_msg:
                 return create_error_response(
-                    "No Video Info",
-                    "Could not retrieve video information",
-                    ["Try a different video", "The video may be private"]
+                    "Video Not Found",
+                    "This video is not available",
+                    [
+                        "The video may have been deleted",
+                        "Check if the video ID is correct",
+                        "Try searching for the song again"
+                    ]
                 )
-            
-            # Get the best audio stream
-            formats = info.get('formats', [])
-            audio_url = None
-            
-            # Priority order for audio formats
-            format_priorities = ['m4a', 'mp3', 'webm', 'mp4']
-            
-            # First try to find audio-only streams
-            for priority in format_priorities:
-                for fmt in formats:
-                    if (fmt.get('acodec') != 'none' and 
-                        fmt.get('vcodec') == 'none' and 
-                        fmt.get('ext') == priority):
-                        audio_url = fmt.get('url')
-                        logger.info(f"Found {priority} audio-only stream")
-                        break
-                if audio_url:
-                    break
-            
-            # If no audio-only format found, try any format with audio
-            if not audio_url:
-                for fmt in formats:
-                    if fmt.get('acodec') != 'none':
-                        audio_url = fmt.get('url')
-                        logger.info(f"Using mixed format: {fmt.get('ext', 'unknown')}")
-                        break
-            
-            if not audio_url:
+            else:
                 return create_error_response(
-                    "No Audio Stream",
-                    "No playable audio stream found for this video",
+                    "Extraction Failed",
+                    f"Could not extract video: {str(e)[:100]}",
                     [
-                        "This video may not have audio",
                         "Try a different video",
-                        "The video format may not be supported"
+                        "Check your internet connection",
+                        "YouTube may be blocking requests"
                     ]
                 )
-            
-            # Test if the URL is accessible
-            try:
-                response = requests.head(audio_url, timeout=5, headers={
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                })
-                if response.status_code >= 400:
-                    logger.warning(f"Stream URL returned status {response.status_code}")
-            except requests.RequestException as e:
-                logger.warning(f"Could not verify stream URL: {e}")
-            
-            play_response = PlayResponse(
-                stream_url=audio_url,
-                title=info.get('title', 'Unknown Title'),
-                duration=info.get('duration_string', 'Unknown')
+        
+        if not info:
+            return create_error_response(
+                "No Video Info",
+                "Could not retrieve video information",
+                ["Try a different video", "The video may be private"]
             )
-            
-            # Cache the successful response
-            stream_cache[cache_key] = {
-                'data': play_response.dict(),
-                'timestamp': datetime.now()
-            }
-            
-            # Clean old cache entries
-            current_time = datetime.now()
-            expired_keys = [
-                key for key, value in stream_cache.items()
-                if current_time - value['timestamp'] > CACHE_DURATION
-            ]
-            for expired_key in expired_keys:
-                del stream_cache[expired_key]
-            
-            logger.info(f"Successfully extracted stream URL for {video_id}")
-            return play_response
+        
+        # Get the best audio stream
+        formats = info.get('formats', [])
+        fmt = select_audio_format(info)
+        audio_url = fmt.get('url') if fmt else None
+        if audio_url:
+            kind = "audio-only" if fmt.get('vcodec') == 'none' else "mixed"
+            logger.info(f"Using {fmt.get('ext', 'unknown')} {kind} stream")
+        
+        if not audio_url:
+            return create_error_response(
+                "No Audio Stream",
+                "No playable audio stream found for this video",
+                [
+                    "This video may not have audio",
+                    "Try a different video",
+                    "The video format may not be supported"
+                ]
+            )
+        
+        play_response = PlayResponse(
+            stream_url=audio_url,
+            title=info.get('title', 'Unknown Title'),
+            duration=info.get('duration_string', 'Unknown')
+        )
+        
+        # Cache the successful response until shortly before the URL expires
+        ttl = stream_cache.ttl_for(audio_url)
+        stream_cache.set(video_id, play_response.dict(), ttl)
+        if ttl > 0:
+            await asyncio.to_thread(
+                persistent_cache.put, video_id, play_response.dict(), compact_formats(formats), time.time() + ttl
+            )
+        
+        # Check the URL is reachable without holding up the response
+        schedule_stream_validation(video_id, audio_url)
+        
+        logger.info(f"Successfully extracted stream URL for {video_id}")
+        return play_response
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error getting stream URL for {video_id}: {str(e)}")
         return create_error_response(
@@ -487,94 +2514,805 @@ async def get_stream_url(video_id: str):
         )
 
 @app.get("/library")
-async def get_library():
+async def get_library(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Page size (all songs if omitted)"),
+    offset: int = Query(0, ge=0, description="Number of songs to skip"),
+    sort: str = Query("modified", pattern="^(modified|name|size|duration)$", description="Sort key"),
+    order: str = Query("desc", pattern="^(asc|desc)$", description="Sort direction")
+):
     """Get list of uploaded songs with metadata"""
     try:
-        songs = []
+        # The index version changes on every upload/delete, so it identifies the listing
+        version = await asyncio.to_thread(library.version)
+        etag = f'"lib-{version}-{sort}-{order}-{offset}-{limit or "all"}"'
+        if is_not_modified(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
         
-        if UPLOAD_DIR.exists():
-            for file_path in UPLOAD_DIR.iterdir():
-                if file_path.is_file() and file_path.suffix.lower() in ALLOWED_EXTENSIONS:
-                    stat = file_path.stat()
-                    songs.append({
-                        'id': file_path.name,
-                        'filename': file_path.name,
-                        'original_name': file_path.stem,
-                        'size': stat.st_size,
-                        'modified': stat.st_mtime,
-                        'url': f'/songs/{file_path.name}',
-                        'source': 'local'
-                    })
+        started = time.perf_counter()
+        rows, total, version = await asyncio.to_thread(
+            library.list_songs, sort, order == "desc", limit, offset
+        )
+        library_scan_seconds.observe(time.perf_counter() - started)
+        etag = f'"lib-{version}-{sort}-{order}-{offset}-{limit or "all"}"'
         
-        # Sort by modification time (newest first)
-        songs.sort(key=lambda x: x['modified'], reverse=True)
+        songs = [
+            {
+                'id': song['filename'],
+                'filename': song['filename'],
+                'original_name': song['original_name'],
+                'size': song['size'],
+                'modified': song['created_at'],
+                'title': song['title'],
+                'artist': song['artist'],
+                'album': song['album'],
+                'duration': song['duration'],
+                'bitrate': song['bitrate'],
+                'codec': song['codec'],
+                'url': f"/songs/{song['filename']}",
+                'source': 'local'
+            }
+            for song in rows
+        ]
         
-        return {
-            'songs': songs,
-            'total': len(songs)
-        }
+        return JSONResponse(
+            content={
+                'songs': songs,
+                'total': total,
+                'offset': offset,
+                'limit': limit
+            },
+            headers={"ETag": etag, "Cache-Control": "no-cache"}
+        )
     
     except Exception as e:
         logger.error(f"Failed to get library: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to get library")
 
-@app.delete("/songs/{filename}")
-async def delete_song(filename: str):
-    """Delete an uploaded song"""
-    file_path = UPLOAD_DIR / filename
-    
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found")
+@app.delete("/songs/{filename}")
+async def delete_song(filename: str):
+    """Delete an uploaded song (drops one reference to the stored content)"""
+    try:
+        removed = await asyncio.to_thread(library.remove, filename)
+    except Exception as e:
+        logger.error(f"Failed to delete file {filename}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to delete file")
+    
+    if removed is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    if removed:
+        logger.info(f"File deleted successfully: {filename}")
+    else:
+        logger.info(f"Reference {filename} deleted, content still shared")
+    return {"message": f"File {filename} deleted successfully"}
+
+@app.get("/api/yt/stream/{video_id}")
+async def api_stream_redirect(video_id: str, request: Request):
+    """Redirect endpoint for frontend compatibility - calls the main play endpoint"""
+    try:
+        # Call the main play endpoint
+        result = await get_stream_url(video_id, request)
+        
+        # If it's a PlayResponse object, convert to the expected format
+        if isinstance(result, PlayResponse):
+            return JSONResponse(
+                status_code=200,
+                content=stream_payload(video_id, result, request)
+            )
+        # If it's an ErrorResponse, return error
+        elif isinstance(result, ErrorResponse):
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "error": result.error,
+                    "detail": result.detail
+                }
+            )
+        # Handle any other response format
+        else:
+            return result
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"API stream redirect error: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "error": "Internal server error",
+                "detail": str(e)
+            }
+        )
+
+def cached_stream_url(video_id: str, request: Request) -> str:
+    """Absolute URL of a local copy - the frontend may live on another origin"""
+    return str(request.base_url).rstrip("/") + f"/cached/{video_id}"
+
+def stream_payload(video_id: str, result: PlayResponse, request: Request) -> dict:
+    """Frontend-facing body for a resolved stream"""
+    payload = {
+        "url": result.stream_url,
+        "title": result.title,
+        "duration": result.duration,
+        "video_id": video_id
+    }
+    if RELAY_PLAYBACK:
+        # Shared upstream fetch that survives googlevideo URL expiry
+        payload["relay_url"] = str(request.base_url).rstrip("/") + f"/stream/{video_id}"
+    return payload
+
+async def resolve_batch_item(video_id: str, request: Request, limiter: Optional[asyncio.Semaphore] = None) -> dict:
+    """Resolve one batch entry into an NDJSON record, never raising"""
+    try:
+        local = audio_cache.entries.get(video_id)
+        if local is not None:
+            result = PlayResponse(stream_url=cached_stream_url(video_id, request), title=local['title'], duration=local['duration'])
+        elif limiter is None:
+            result = await lookup_stream(video_id)
+        else:
+            async with limiter:
+                result = await lookup_stream(video_id)
+    except HTTPException as e:
+        record = {"video_id": video_id, "error": "Unavailable", "detail": e.detail}
+        if e.headers and "Retry-After" in e.headers:
+            record["retry_after"] = int(e.headers["Retry-After"])
+        return record
+    except Exception as e:
+        logger.error(f"Batch resolution error for {video_id}: {str(e)}")
+        return {"video_id": video_id, "error": "Internal server error", "detail": str(e)}
+
+    if isinstance(result, PlayResponse):
+        return stream_payload(video_id, result, request)
+    return {"video_id": video_id, "error": result.error, "detail": result.detail}
+
+@app.post("/api/yt/stream:batch")
+async def api_stream_batch(batch: BatchStreamRequest, request: Request):
+    """Resolve many videos at once, streaming NDJSON records as each completes"""
+    if not YT_DLP_AVAILABLE:
+        raise HTTPException(status_code=503, detail="yt-dlp not available. Please install yt-dlp")
+
+    # Duplicates resolve once; order only matters for picking hits vs misses
+    video_ids = list(dict.fromkeys(v.strip() for v in batch.video_ids if v and v.strip()))
+    if not video_ids:
+        raise HTTPException(status_code=400, detail="video_ids must not be empty")
+    if len(video_ids) > BATCH_STREAM_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_STREAM_MAX_IDS} video IDs per batch")
+
+    hits = [v for v in video_ids if v in audio_cache.entries or stream_cache.peek(v)]
+    misses = [v for v in video_ids if v not in hits]
+    logger.info(f"Batch resolution: {len(hits)} cached, {len(misses)} to resolve")
+
+    async def records():
+        for video_id in hits:
+            yield json.dumps(await resolve_batch_item(video_id, request)) + "\n"
+
+        # Cap this batch's share of the extraction pool so single requests still get through
+        limiter = asyncio.Semaphore(BATCH_STREAM_CONCURRENCY)
+        tasks = [asyncio.ensure_future(resolve_batch_item(v, request, limiter)) for v in misses]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            # Client went away mid-batch; stop queueing work nobody will read
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        records(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-store"}
+    )
+
+@app.post("/api/yt/prefetch", status_code=202)
+async def api_stream_prefetch(batch: BatchStreamRequest):
+    """Queue upcoming videos for background resolution"""
+    queued = prefetcher.submit(batch.video_ids[:PREFETCH_UPCOMING_LIMIT])
+    return {"queued": queued, "enabled": PREFETCH_ENABLED}
+
+class Prefetcher:
+    """Rate-limited background queue that warms the stream cache for tracks likely to play next"""
+
+    def __init__(self, rate_per_minute: float, max_pending: int, reserved_workers: int):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.max_pending = max_pending
+        self.reserved_workers = reserved_workers
+        self.pending: "OrderedDict[str, None]" = OrderedDict()
+        self.warmed: "OrderedDict[str, float]" = OrderedDict()  # video_id -> when it was prefetched
+        self.current: Optional[str] = None
+        self.current_claimed = False
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._next_start = 0.0
+        self.queued = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.prefetched = 0
+        self.failed = 0
+        self.hits = 0
+        self.unused = 0
+
+    def _is_warm(self, video_id: str) -> bool:
+        return video_id in audio_cache.entries or stream_cache.peek(video_id)
+
+    def submit(self, video_ids: List[str]) -> int:
+        """Queue videos for prefetch, returns how many were newly queued"""
+        if not PREFETCH_ENABLED:
+            return 0
+        queued = 0
+        for video_id in video_ids:
+            if not isinstance(video_id, str) or not video_id or video_id in self.pending or video_id == self.current:
+                continue
+            if self._is_warm(video_id):
+                self.skipped += 1
+                continue
+            self.pending[video_id] = None
+            queued += 1
+            # The oldest requests are the least likely to still be "up next"
+            if len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+        self.queued += queued
+        if queued:
+            if self._task is None or self._task.done():
+                self._task = spawn_background(self._run())
+            self._wakeup.set()
+        return queued
+
+    def claim(self, video_id: str):
+        """Count a foreground lookup that a prefetch has already served (or is serving)"""
+        if self.warmed.pop(video_id, None) is not None:
+            self.hits += 1
+        elif video_id == self.current and not self.current_claimed:
+            self.current_claimed = True
+            self.hits += 1
+
+    async def _wait_for_capacity(self):
+        # Never take the last free extraction workers from /play
+        limit = max(1, extraction_pool.max_workers - self.reserved_workers)
+        while extraction_pool.in_flight() >= limit:
+            await asyncio.sleep(PREFETCH_BACKOFF)
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._next_start - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._wait_for_capacity()
+            if not self.pending:
+                continue
+
+            video_id, _ = self.pending.popitem(last=False)
+            if self._is_warm(video_id):
+                self.skipped += 1
+                continue
+
+            self._next_start = time.monotonic() + self.interval
+            self.current = video_id
+            self.current_claimed = False
+            try:
+                result = await stream_flights.do(video_id, resolve_stream_url, video_id)
+            except Exception as e:
+                self.failed += 1
+                logger.info(f"Prefetch of {video_id} failed: {e}")
+                continue
+            finally:
+                self.current = None
+
+            if not isinstance(result, PlayResponse):
+                self.failed += 1
+                continue
+            self.prefetched += 1
+            if not self.current_claimed:
+                self.warmed[video_id] = time.time()
+                if len(self.warmed) > PREFETCH_TRACKED:
+                    self.warmed.popitem(last=False)
+                    self.unused += 1
+            logger.info(f"Prefetched stream URL for {video_id}")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': PREFETCH_ENABLED,
+            'pending': len(self.pending),
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'skipped': self.skipped,
+            'prefetched': self.prefetched,
+            'failed': self.failed,
+            'hits': self.hits,
+            'unused': self.unused,
+            'hit_rate': round(self.hits / self.prefetched, 4) if self.prefetched else 0.0
+        }
+
+
+prefetcher = Prefetcher(PREFETCH_RATE, PREFETCH_MAX_PENDING, PREFETCH_RESERVED_WORKERS)
+
+
+class RelayError(Exception):
+    """Raised when the relay cannot obtain an upstream stream"""
+
+
+async def resolve_relay_url(video_id: str) -> str:
+    """Upstream URL for a video through the regular (cached, coalesced) extraction path"""
+    result = await lookup_stream(video_id)
+    if isinstance(result, PlayResponse):
+        return result.stream_url
+    raise RelayError(f"{result.error}: {result.detail}")
+
+
+class RelayFetch:
+    """One upstream fetch whose bytes are fanned out to every reader of the same video and range"""
+
+    def __init__(self, video_id: str, byte_range: Optional[str]):
+        self.video_id = video_id
+        self.byte_range = byte_range
+        self.key = (video_id, byte_range or "")
+        self.chunks: List[bytes] = []
+        self.base = 0  # Index of chunks[0] in the whole body; chunks every reader has passed are dropped
+        self.size = 0
+        self.buffered = 0  # Bytes currently held in chunks
+        self.positions: Dict[int, int] = {}  # Reader -> index of the next chunk it will read
+        self._next_reader = 0
+        self.status = 502
+        self.headers: Dict[str, str] = {}
+        self.error: Optional[str] = None
+        self.done = False
+        self.ready = asyncio.Event()
+        self._changed = asyncio.Condition()
+        self._drained = asyncio.Event()  # Set whenever a reader advances or leaves
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def joinable(self) -> bool:
+        # Late joiners replay from the first byte, so stop sharing once the buffer gets large
+        return not self.done and self.size < RELAY_SHARE_LIMIT
+
+    @property
+    def readers(self) -> int:
+        return len(self.positions)
+
+    def acquire(self) -> int:
+        """Register a reader starting at the first byte (only valid while the fetch is joinable)"""
+        reader = self._next_reader
+        self._next_reader += 1
+        self.positions[reader] = 0
+        return reader
+
+    def _trim(self):
+        # Once nobody new can join, the buffer only has to cover the slowest current reader
+        if self.joinable or not self.positions:
+            return
+        consumed = min(self.positions.values()) - self.base
+        if consumed > 0:
+            self.buffered -= sum(len(chunk) for chunk in self.chunks[:consumed])
+            del self.chunks[:consumed]
+            self.base += consumed
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _open_upstream(self) -> httpx.Response:
+        url = await resolve_relay_url(self.video_id)
+        headers = {"Range": self.byte_range} if self.byte_range else {}
+        response = await http_client.send(http_client.build_request("GET", url, headers=headers), stream=True)
+        if response.status_code == 403:
+            # The googlevideo URL expired or was revoked: drop it everywhere and resolve a fresh one
+            await response.aclose()
+            relay_stats['re_resolved'] += 1
+            logger.info(f"Relay upstream for {self.video_id} returned 403, re-resolving")
+            stream_cache.invalidate(self.video_id)
+            await asyncio.to_thread(persistent_cache.delete, self.video_id)
+            url = await resolve_relay_url(self.video_id)
+            response = await http_client.send(http_client.build_request("GET", url, headers=headers), stream=True)
+        return response
+
+    async def _run(self):
+        response = None
+        try:
+            response = await self._open_upstream()
+            self.status = response.status_code
+            self.headers = {
+                name: response.headers[name] for name in RELAY_PASSTHROUGH_HEADERS if name in response.headers
+            }
+            if response.status_code >= 400:
+                self.error = f"Upstream returned {response.status_code}"
+            self.ready.set()
+            if self.error:
+                return
+
+            async for chunk in response.aiter_bytes(RELAY_CHUNK_SIZE):
+                # Past the sharing window the readers set the pace; an <audio> element reads in real time
+                while self.positions and not self.joinable and self.buffered > RELAY_BUFFER_LIMIT:
+                    relay_stats['throttled'] += 1
+                    self._drained.clear()
+                    await self._drained.wait()
+                async with self._changed:
+                    self.chunks.append(chunk)
+                    self.size += len(chunk)
+                    self.buffered += len(chunk)
+                    self._changed.notify_all()
+                relay_stats['upstream_bytes'] += len(chunk)
+        except (RelayError, HTTPException, httpx.HTTPError) as e:
+            self.error = getattr(e, 'detail', None) or str(e)
+            logger.warning(f"Relay fetch for {self.video_id} failed: {self.error}")
+        finally:
+            self.done = True
+            self.ready.set()
+            if relay_fetches.get(self.key) is self:
+                del relay_fetches[self.key]
+            async with self._changed:
+                self._changed.notify_all()
+            if response is not None:
+                await response.aclose()
+
+    async def read(self, reader: int):
+        """Yield the body from the first byte, following the upstream as it arrives"""
+        position = self.positions[reader]
+        try:
+            while True:
+                async with self._changed:
+                    while position >= self.base + len(self.chunks) and not self.done:
+                        await self._changed.wait()
+                    pending = self.chunks[position - self.base:]
+                    finished = self.done
+                position += len(pending)
+                self.positions[reader] = position
+                self._trim()
+                self._drained.set()
+                for chunk in pending:
+                    relay_stats['bytes_served'] += len(chunk)
+                    yield chunk
+                if finished and position >= self.base + len(self.chunks):
+                    break
+        finally:
+            self.release(reader)
+
+    def release(self, reader: int):
+        if self.positions.pop(reader, None) is None:
+            return
+        if not self.positions and not self.done and self._task is not None:
+            # Nobody is listening any more - stop pulling from upstream
+            self._task.cancel()
+        self._trim()
+        self._drained.set()
+
+
+relay_fetches: Dict[tuple, RelayFetch] = {}
+relay_stats = {'fetches': 0, 'shared_readers': 0, 're_resolved': 0, 'upstream_bytes': 0, 'bytes_served': 0, 'throttled': 0}
+
+
+@app.get("/stream/{video_id}")
+async def relay_stream(video_id: str, request: Request):
+    """Relay YouTube audio through the server, sharing upstream fetches and passing Range through"""
+    if not YT_DLP_AVAILABLE:
+        raise HTTPException(status_code=503, detail="yt-dlp not available. Please install yt-dlp")
+    
+    if audio_cache.get(video_id) is not None:
+        return await serve_cached_audio(video_id, request)
+    
+    byte_range = request.headers.get("range")
+    key = (video_id, byte_range or "")
+    fetch = relay_fetches.get(key)
+    if fetch is None or not fetch.joinable:
+        fetch = RelayFetch(video_id, byte_range)
+        relay_fetches[key] = fetch
+        relay_stats['fetches'] += 1
+        fetch.start()
+    else:
+        relay_stats['shared_readers'] += 1
+    reader = fetch.acquire()
+    
+    try:
+        await fetch.ready.wait()
+    except asyncio.CancelledError:
+        # The client went away before the upstream answered
+        fetch.release(reader)
+        raise
+    if fetch.error and not fetch.chunks:
+        fetch.release(reader)
+        return JSONResponse(
+            status_code=502,
+            content={"error": "Relay failed", "detail": fetch.error}
+        )
+    
+    return StreamingResponse(
+        fetch.read(reader),
+        status_code=fetch.status,
+        headers=fetch.headers,
+        media_type=fetch.headers.get("content-type", "audio/mp4")
+    )
+
+class AudioCache:
+    """Local copies of frequently played YouTube tracks, bounded by a byte budget (LFU, then LRU)"""
+
+    def __init__(self, directory: Path, max_bytes: int, hot_plays: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hot_plays = hot_plays
+        self.entries: Dict[str, dict] = {}
+        self.bytes = 0
+        self.plays: "OrderedDict[str, tuple]" = OrderedDict()  # video_id -> (plays, monotonic time of the last counted one)
+        self.downloading: Set[str] = set()
+        self.oversized: Set[str] = set()  # Tracks too large to be worth a local copy
+        self.hits = 0
+        self.downloads = 0
+        self.evictions = 0
+
+    def load(self):
+        """Index copies left by earlier runs (sidecar JSON next to each audio file)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for sidecar in self.directory.glob("*.json"):
+            try:
+                entry = json.loads(sidecar.read_text())
+                audio_path = self.directory / entry['file']
+                entry['size'] = audio_path.stat().st_size
+            except (OSError, ValueError, KeyError):
+                sidecar.unlink(missing_ok=True)
+                continue
+            entry.setdefault('hits', 0)
+            entry['last_access'] = sidecar.stat().st_mtime
+            self.entries[sidecar.stem] = entry
+            self.bytes += entry['size']
+        for partial in self.directory.glob("*.part"):
+            partial.unlink(missing_ok=True)
+
+    def get(self, video_id: str) -> Optional[dict]:
+        entry = self.entries.get(video_id)
+        if entry is not None:
+            entry['hits'] += 1
+            entry['last_access'] = time.time()
+            self.hits += 1
+        return entry
+
+    def path_for(self, entry: dict) -> Path:
+        return self.directory / entry['file']
+
+    def record_play(self, video_id: str, play: PlayResponse):
+        """Count a remote play and start a local download once the track is hot"""
+        # A song change in a room sends every listener here at once; that is one play, not one per listener
+        now = time.monotonic()
+        count, counted_at = self.plays.pop(video_id, (0, -math.inf))
+        if now - counted_at >= AUDIO_CACHE_PLAY_WINDOW:
+            count, counted_at = count + 1, now
+        self.plays[video_id] = (count, counted_at)
+        if len(self.plays) > AUDIO_CACHE_TRACKED_VIDEOS:
+            self.plays.popitem(last=False)
+
+        if (count >= self.hot_plays and video_id not in self.entries and video_id not in self.downloading
+                and video_id not in self.oversized and len(self.downloading) < AUDIO_CACHE_MAX_DOWNLOADS
+                and http_client is not None):
+            self.downloading.add(video_id)
+            spawn_background(self._download(video_id, play))
+
+    async def _download(self, video_id: str, play: PlayResponse):
+        temp_path = self.directory / f"{video_id}.part"
+        try:
+            async with http_client.stream("GET", play.stream_url) as response:
+                if response.status_code != 200:
+                    logger.warning(f"Local copy of {video_id} skipped: upstream returned {response.status_code}")
+                    return
+                content_type = response.headers.get("content-type", "audio/mp4").split(";")[0]
+                size = 0
+                async with aiofiles.open(temp_path, 'wb') as f:
+                    async for chunk in response.aiter_bytes(RELAY_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_bytes // 10:
+                            logger.info(f"Local copy of {video_id} skipped: larger than a tenth of the budget")
+                            if len(self.oversized) >= AUDIO_CACHE_TRACKED_VIDEOS:
+                                self.oversized.clear()
+                            self.oversized.add(video_id)
+                            return
+                        await f.write(chunk)
+
+            filename = f"{video_id}{AUDIO_CACHE_EXTENSIONS.get(content_type, '.bin')}"
+            entry = {
+                'file': filename,
+                'content_type': content_type,
+                'title': play.title,
+                'duration': play.duration,
+                'size': size,
+                'hits': 0,
+                'last_access': time.time()
+            }
+            await asyncio.to_thread(self._write, video_id, temp_path, entry)
+            self.entries[video_id] = entry
+            self.bytes += entry['size']
+            self.downloads += 1
+            victims = self._evict(keep=video_id)
+            if victims:
+                await asyncio.to_thread(self._remove_files, victims)
+            logger.info(f"Stored local copy of hot track {video_id} ({size} bytes)")
+        except (httpx.HTTPError, OSError) as e:
+            logger.warning(f"Local copy of {video_id} failed: {e}")
+        finally:
+            self.downloading.discard(video_id)
+            temp_path.unlink(missing_ok=True)
+
+    def _write(self, video_id: str, temp_path: Path, entry: dict):
+        os.replace(temp_path, self.directory / entry['file'])
+        sidecar = {key: value for key, value in entry.items() if key not in ('size', 'last_access')}
+        (self.directory / f"{video_id}.json").write_text(json.dumps(sidecar))
+
+    def _evict(self, keep: str) -> List[tuple]:
+        """Drop entries until the budget fits; returns (video_id, entry) pairs whose files must go"""
+        victims = []
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            # Least frequently used first, least recently used among equals
+            victim = min(
+                (key for key in self.entries if key != keep),
+                key=lambda key: (self.entries[key]['hits'], self.entries[key]['last_access'])
+            )
+            entry = self.entries.pop(victim)
+            self.bytes -= entry['size']
+            self.evictions += 1
+            victims.append((victim, entry))
+        return victims
+
+    def _remove_files(self, victims: List[tuple]):
+        for video_id, entry in victims:
+            self.path_for(entry).unlink(missing_ok=True)
+            (self.directory / f"{video_id}.json").unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hot_plays': self.hot_plays,
+            'hits': self.hits,
+            'downloads': self.downloads,
+            'downloading': len(self.downloading),
+            'evictions': self.evictions
+        }
+
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_HOT_PLAYS)
+
+
+@app.api_route("/cached/{video_id}", methods=["GET", "HEAD"])
+async def serve_cached_audio(video_id: str, request: Request):
+    """Serve the local copy of a hot YouTube track (same validators and ranges as /songs)"""
+    entry = audio_cache.entries.get(video_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Track not cached")
     
     try:
-        file_path.unlink()
-        logger.info(f"File deleted successfully: {filename}")
-        return {"message": f"File {filename} deleted successfully"}
+        stat_result = await asyncio.to_thread(os.stat, audio_cache.path_for(entry))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Track not cached")
     
-    except Exception as e:
-        logger.error(f"Failed to delete file {filename}: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to delete file")
+    etag = f'"{video_id}-{int(stat_result.st_mtime)}-{stat_result.st_size}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=3600",
+        "Access-Control-Allow-Origin": "*"
+    }
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+    
+    return FileResponse(
+        path=audio_cache.path_for(entry),
+        media_type=entry['content_type'],
+        headers=headers,
+        stat_result=stat_result
+    )
 
-@app.get("/api/yt/stream/{video_id}")
-async def api_stream_redirect(video_id: str):
-    """Redirect endpoint for frontend compatibility - calls the main play endpoint"""
-    try:
-        # Call the main play endpoint
-        result = await get_stream_url(video_id)
-        
-        # If it's a PlayResponse object, convert to the expected format
-        if isinstance(result, PlayResponse):
-            return JSONResponse(
-                status_code=200,
-                content={
-                    "url": result.stream_url,
-                    "title": result.title,
-                    "duration": result.duration,
-                    "video_id": video_id
-                }
-            )
-        # If it's an ErrorResponse, return error
-        elif isinstance(result, ErrorResponse):
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "error": result.error,
-                    "detail": result.detail
-                }
-            )
-        # Handle any other response format
-        else:
-            return result
+@app.get("/api/stats")
+async def get_stats():
+    """Runtime counters for the stream extraction path"""
+    return {
+        'stream_cache': stream_cache.stats(),
+        'persistent_cache': persistent_cache.stats(),
+        'stream_validation': dict(validation_stats, enabled=STREAM_VALIDATION_ENABLED),
+        'relay': dict(relay_stats, active_fetches=len(relay_fetches)),
+        'audio_cache': audio_cache.stats(),
+        'prefetch': prefetcher.stats(),
+        'extraction_pool': extraction_pool.stats(),
+        'extractors': extractors.stats(),
+        'search_pool': search_pool.stats(),
+        'search_cache': search_cache.stats(),
+        'rooms': dict(rooms.stats(), events=room_event_stats, heartbeat=heartbeats.stats(), backend=room_backend.stats()),
+        'diagnostics': {'watchdog': watchdog.stats(), 'profiler': profiler.stats()},
+        'single_flight': {
+            'extraction': info_flights.stats(),
+            'stream_resolution': stream_flights.stats(),
+            'search': search_flights.stats()
+        }
+    }
+
+@metrics.collector
+def collect_runtime_metrics():
+    """Gauges and counters read from the components' own stats at scrape time"""
+    for cache, stats in (('stream', stream_cache.stats()), ('persistent', persistent_cache.stats()),
+                         ('search', search_cache.stats())):
+        yield "melodrift_cache_hits_total", "counter", "Cache lookups that found an entry", {'cache': cache}, stats['hits']
+        yield "melodrift_cache_misses_total", "counter", "Cache lookups that found nothing", {'cache': cache}, stats['misses']
+    yield "melodrift_cache_hits_total", "counter", "Cache lookups that found an entry", {'cache': 'audio'}, audio_cache.hits
+    for cache, stats in (('stream', stream_cache.stats()), ('search', search_cache.stats()), ('audio', audio_cache.stats())):
+        yield "melodrift_cache_entries", "gauge", "Entries currently cached", {'cache': cache}, stats['entries']
+    for pool in (extraction_pool, search_pool):
+        stats = pool.stats()
+        yield "melodrift_pool_in_flight", "gauge", "Jobs running or queued in a worker pool", {'pool': pool.name}, stats['in_flight']
+        yield "melodrift_pool_rejected_total", "counter", "Jobs refused because a worker pool was saturated", {'pool': pool.name}, stats['rejected']
+        yield "melodrift_pool_timeouts_total", "counter", "Jobs that exceeded the worker pool timeout", {'pool': pool.name}, stats['timed_out']
+    yield "melodrift_rooms", "gauge", "Listen-together rooms held by this process", {}, len(rooms)
+    yield "melodrift_room_connections", "gauge", "WebSocket connections in listen-together rooms", {}, rooms.connections
+    for event, count in room_event_stats.items():
+        yield "melodrift_room_events_total", "counter", "Host room events by outcome", {'outcome': event}, count
+    yield "melodrift_room_heartbeat_reaped_total", "counter", "Room sockets dropped for missing heartbeats", {}, heartbeats.reaped
+    yield "melodrift_relay_bytes_served_total", "counter", "Bytes sent to clients by the audio relay", {}, relay_stats['bytes_served']
+    yield "melodrift_event_loop_lag_max_seconds", "gauge", "Largest event-loop lag seen since startup", {}, loop_lag.max
+    yield "melodrift_event_loop_stalls_total", "counter", "Event-loop stalls caught by the watchdog", {}, watchdog.stalls
+    yield "melodrift_profiles_captured_total", "counter", "Requests profiled", {}, profiler.captured
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/admin/stalls")
+async def admin_stalls(request: Request):
+    """Recent event-loop stalls with the stack captured while the loop was blocked"""
+    require_admin(request)
+    return {'watchdog': watchdog.stats(), 'stalls': list(watchdog.recent)}
+
+@app.get("/admin/profiles")
+async def admin_profiles(request: Request):
+    """Captured request profiles, newest first"""
+    require_admin(request)
+    return {
+        'profiler': profiler.stats(),
+        'profiles': [
+            {key: value for key, value in result.items() if key != 'data'}
+            for result in reversed(profiler.results.values())
+        ]
+    }
+
+@app.get("/admin/profiles/{profile_id}")
+async def admin_profile_download(
+    profile_id: str,
+    request: Request,
+    format: str = Query("raw", pattern="^(raw|text)$", description="raw: .prof / collapsed stacks, text: pstats report")
+):
+    """Download a profile: cProfile data for pstats/snakeviz, or collapsed stacks for flame graphs"""
+    require_admin(request)
+    result = profiler.results.get(profile_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
     
-    except Exception as e:
-        logger.error(f"API stream redirect error: {str(e)}")
-        return JSONResponse(
-            status_code=500,
-            content={
-                "error": "Internal server error",
-                "detail": str(e)
-            }
+    if result['mode'] == "sample":
+        return Response(
+            content=result['data'],
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'}
         )
+    if format == "text":
+        report = await asyncio.to_thread(format_profile_report, result['data'])
+        return Response(content=report, media_type="text/plain; charset=utf-8")
+    return Response(
+        content=result['data'],
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'}
+    )
+
+def format_profile_report(data: bytes) -> str:
+    """pstats report of the heaviest calls in a marshalled cProfile dump"""
+    # pstats loads from anything with create_stats() and a stats dict
+    dump = types.SimpleNamespace(stats=marshal.loads(data), create_stats=lambda: None)
+    stream = io.StringIO()
+    pstats.Stats(dump, stream=stream).sort_stats("cumulative").print_stats(PROFILE_REPORT_LINES)
+    return stream.getvalue()
 
 @app.get("/debug/{video_id}")
 async def debug_video(video_id: str):
@@ -583,32 +3321,31 @@ async def debug_video(video_id: str):
         return {"error": "yt-dlp not available"}
     
     try:
-        ydl_opts = get_yt_dlp_options()
-        ydl_opts['verbose'] = True
+        info = await fetch_video_info(video_id)
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            video_url = f"https://www.youtube.com/watch?v={video_id}"
-            info = ydl.extract_info(video_url, download=False)
-            
-            debug_info = {
-                'title': info.get('title'),
-                'duration': info.get('duration'),
-                'uploader': info.get('uploader'),
-                'formats_count': len(info.get('formats', [])),
-                'available_formats': []
-            }
-            
-            for fmt in info.get('formats', [])[:5]:  # Show first 5 formats
-                debug_info['available_formats'].append({
-                    'format_id': fmt.get('format_id'),
-                    'ext': fmt.get('ext'),
-                    'acodec': fmt.get('acodec'),
-                    'vcodec': fmt.get('vcodec'),
-                    'url_available': bool(fmt.get('url'))
-                })
-            
-            return debug_info
+        debug_info = {
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+            'uploader': info.get('uploader'),
+            'formats_count': len(info.get('formats', [])),
+            'available_formats': []
+        }
+        
+        for fmt in info.get('formats', [])[:5]:  # Show first 5 formats
+            debug_info['available_formats'].append({
+                'format_id': fmt.get('format_id'),
+                'ext': fmt.get('ext'),
+                'acodec': fmt.get('acodec'),
+                'vcodec': fmt.get('vcodec'),
+                'url_available': bool(fmt.get('url'))
+            })
+        
+        return debug_info
     
+    except WorkerPoolSaturated:
+        raise extraction_busy_error()
+    except asyncio.TimeoutError:
+        return {"error": f"Extraction timed out after {EXTRACTION_TIMEOUT:.0f}s"}
     except Exception as e:
         return {"error": str(e)}
 
@@ -633,7 +3370,8 @@ async def internal_error_handler(request: Request, exc: Exception):
 async def http_exception_handler(request: Request, exc: HTTPException):
     return JSONResponse(
         status_code=exc.status_code,
-        content={"error": "HTTP Error", "detail": exc.detail}
+        content={"error": "HTTP Error", "detail": exc.detail},
+        headers=getattr(exc, "headers", None)
     )
 
 # Startup event
@@ -657,39 +3395,859 @@ async def startup_event():
     STATIC_DIR.mkdir(exist_ok=True)
     CACHE_DIR.mkdir(exist_ok=True)
     
+    # Open the song library and fold any pre-dedup uploads into it
+    await asyncio.to_thread(library.open)
+    migrated = await asyncio.to_thread(library.migrate_flat_files, UPLOAD_DIR)
+    if migrated:
+        logger.info(f"Moved {migrated} existing upload(s) into content-addressed storage")
+    reconciled = await asyncio.to_thread(library.reconcile)
+    if reconciled:
+        logger.info(f"Library index reconciled {reconciled} change(s) from disk")
+    backfilled = await asyncio.to_thread(library.backfill_metadata)
+    if backfilled:
+        logger.info(f"Read audio metadata for {backfilled} existing song(s)")
+    
+    await asyncio.to_thread(audio_cache.load)
+    
+    global http_client, room_backend
+    http_client = httpx.AsyncClient(
+        headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'},
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        follow_redirects=True
+    )
+    
+    if PERSISTENT_CACHE_ENABLED:
+        try:
+            await asyncio.to_thread(persistent_cache.open)
+            logger.info(f"Persistent stream cache at {PERSISTENT_CACHE_PATH}")
+        except sqlite3.Error as e:
+            logger.warning(f"Persistent stream cache disabled: {e}")
+    
+    try:
+        await room_backend.start()
+        logger.info(f"Room backend: {room_backend.name}")
+    except (OSError, asyncio.TimeoutError, RespError) as e:
+        logger.warning(f"Room backend {room_backend.name} unavailable ({e}), keeping rooms in process")
+        room_backend = RoomBackend()
+    rooms.start()
+    heartbeats.start()
+    loop_lag.start()
+    watchdog.start()
+    
     logger.info("SpotifyClone API started successfully!")
 
+# Listen-together rooms
+_CLOCK_EPOCH = time.time() - time.monotonic()
+
+
+def server_clock() -> float:
+    """Milliseconds on a monotonic clock, aligned with the Unix epoch at startup"""
+    return round((_CLOCK_EPOCH + time.monotonic()) * 1000, 1)
+
+
+class Room:
+    """Playback state and connections of one listen-together room"""
+
+    __slots__ = (
+        'room_id', 'host_id', 'current_song', 'is_playing', 'current_time', 'last_update', 'seq', 'at', 'history',
+        'listeners', 'connections', 'scheduler', 'created_at', 'joins', 'leaves', 'messages', 'broadcasts',
+        'send_failures', 'dropped', 'merged', 'throttled', 'timeouts'
+    )
+
+    def __init__(self, room_id: str, host_id: str):
+        self.room_id = room_id
+        self.host_id = host_id
+        self.current_song: Optional[dict] = None
+        self.is_playing = False
+        self.current_time = 0.0
+        self.last_update = datetime.now().isoformat()
+        self.seq = 0  # Bumped on every state change
+        self.at = server_clock()  # When current_time was the playback position
+        self.history: deque = deque(maxlen=ROOM_DELTA_HISTORY)
+        self.listeners = 0  # Across every process sharing the room
+        self.connections: Set["RoomConnection"] = set()  # Only this process's sockets
+        self.scheduler = RoomScheduler(self)
+        self.created_at = time.time()
+        self.joins = 0
+        self.leaves = 0
+        self.messages = 0
+        self.broadcasts = 0
+        self.send_failures = 0
+        self.dropped = 0
+        self.merged = 0
+        self.throttled = 0
+        self.timeouts = 0
+
+    def commit(self, changes: dict, at: Optional[float] = None) -> dict:
+        """Apply a host change, anchored at the server time the host sent it, and return its delta"""
+        self.seq += 1
+        self.at = server_clock() if at is None else at
+        for name, value in changes.items():
+            setattr(self, name, value)
+        self.last_update = datetime.now().isoformat()
+        delta = {'type': 'state', 'seq': self.seq, 'at': self.at, 'changes': changes}
+        self.history.append(delta)
+        return delta
+
+    def apply_delta(self, delta: dict):
+        """Adopt a delta committed by another process"""
+        if delta['seq'] <= self.seq:
+            return
+        for name, value in delta['changes'].items():
+            if name in ('current_song', 'is_playing', 'current_time'):
+                setattr(self, name, value)
+        self.seq = delta['seq']
+        self.at = delta['at']
+        self.last_update = datetime.now().isoformat()
+        self.history.append(delta)
+
+    def deltas_since(self, seq: int) -> Optional[List[dict]]:
+        """Deltas after seq, or None when they are no longer all in the history"""
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.history or seq < self.history[0]['seq'] - 1:
+            return None
+        return [delta for delta in self.history if delta['seq'] > seq]
+
+    def apply(self, state: dict):
+        """Adopt state written by another process"""
+        self.current_song = state.get('current_song')
+        self.is_playing = bool(state.get('is_playing'))
+        self.current_time = state.get('current_time', 0.0)
+        self.last_update = state.get('last_update', self.last_update)
+        if state.get('seq', self.seq) != self.seq:
+            # Local deltas no longer lead up to the adopted state; catch-ups fall back to snapshots
+            self.history.clear()
+        self.seq = state.get('seq', self.seq)
+        self.at = state.get('at', self.at)
+        if 'listener_count' in state:
+            self.listeners = state['listener_count']
+
+    def snapshot(self, is_host: bool) -> dict:
+        """Full state for a client that has nothing (or too little) to catch up from"""
+        return {
+            'type': 'snapshot',
+            'protocol': ROOM_PROTOCOL_VERSION,
+            'state': self.state(),
+            'server_time': server_clock(),
+            'is_host': is_host
+        }
+
+    def state(self) -> dict:
+        """Room state as sent to clients"""
+        return {
+            'host_id': self.host_id,
+            'current_song': self.current_song,
+            'is_playing': self.is_playing,
+            'current_time': self.current_time,
+            'last_update': self.last_update,
+            'seq': self.seq,
+            'at': self.at,
+            'listener_count': self.listeners
+        }
+
+    def stats(self) -> dict:
+        return {
+            'created_at': self.created_at,
+            'joins': self.joins,
+            'leaves': self.leaves,
+            'messages': self.messages,
+            'broadcasts': self.broadcasts,
+            'send_failures': self.send_failures,
+            'dropped': self.dropped,
+            'merged': self.merged,
+            'throttled': self.throttled,
+            'timeouts': self.timeouts
+        }
+
+
+room_event_stats = {'committed': 0, 'merged': 0, 'throttled': 0, 'dropped': 0}
+
+
+class RoomScheduler:
+    """Merges bursts of host playback changes into one authoritative update per window"""
+
+    __slots__ = ('room', 'pending', 'pending_at', 'origin', 'timer', 'last_commit')
+
+    def __init__(self, room: Room):
+        self.room = room
+        self.pending: Optional[dict] = None
+        self.pending_at = 0.0  # Server time of the latest merged change, which its current_time refers to
+        self.origin: Optional["RoomConnection"] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.last_commit = 0.0
+
+    async def submit(self, changes: dict, origin: "RoomConnection", urgent: bool = False):
+        """Commit now if the window is open, otherwise fold into the update sent when it closes"""
+        at = server_clock()
+        if self.pending is not None:
+            # Later values win: a scrub ends where the host let go
+            self.pending.update(changes)
+            self.pending_at = at
+            self.origin = origin
+            self.room.merged += 1
+            room_event_stats['merged'] += 1
+            if not urgent:
+                return
+            changes = self.pending
+            self.cancel()
+        elif not urgent:
+            wait = self.last_commit + ROOM_EVENT_WINDOW - time.monotonic()
+            if wait > 0:
+                self.pending = dict(changes)
+                self.pending_at = at
+                self.origin = origin
+                self.timer = asyncio.get_running_loop().call_later(wait, lambda: spawn_background(self.flush()))
+                return
+        await self._commit(changes, origin, at)
+
+    async def flush(self):
+        if self.pending is None:
+            return
+        changes, origin, at = self.pending, self.origin, self.pending_at
+        self.cancel()
+        await self._commit(changes, origin, at)
+
+    async def _commit(self, changes: dict, origin: "RoomConnection", at: float):
+        room = self.room
+        self.last_commit = time.monotonic()
+        room_event_stats['committed'] += 1
+        # current_time always goes out since it is re-anchored to the new 'at'
+        changes = {name: value for name, value in changes.items() if name == 'current_time' or getattr(room, name) != value}
+        delta = room.commit(changes, at)
+        await room_backend.save_room(room)
+        await broadcast_to_room(room, delta, exclude=origin)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        self.pending = None
+        self.origin = None
+
+
+def encode_message(message: dict) -> str:
+    """Serialize a room message once for all of its recipients"""
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(message).decode()
+        except TypeError:
+            # Values orjson refuses (e.g. integers beyond 64 bits) still encode with json
+            pass
+    return json.dumps(message)
+
+
+class RoomConnection:
+    """A socket in a room, with a bounded outbound queue drained by its own writer task"""
+
+    __slots__ = (
+        'websocket', 'user_id', 'room', 'queue', 'writer', 'closed', 'last_sync',
+        'task', 'last_seen', 'wheel_slot', 'left'
+    )
+
+    def __init__(self, websocket: WebSocket, user_id: str, room: Room):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.room = room
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=ROOM_SEND_QUEUE)
+        self.writer = spawn_background(self._write())
+        self.closed = False
+        self.last_sync = 0.0
+        self.task: Optional[asyncio.Task] = None  # The endpoint reading from this socket
+        self.last_seen = time.monotonic()
+        self.wheel_slot: Optional[int] = None
+        self.left = False
+
+    def send(self, payload: str) -> bool:
+        """Queue an encoded message without waiting, applying the slow consumer policy when full"""
+        if self.closed:
+            return False
+        if self.queue.full():
+            self.room.dropped += 1
+            room_event_stats['dropped'] += 1
+            if ROOM_SLOW_CONSUMER_POLICY == "disconnect":
+                self.abort("outbound queue full")
+                return False
+            # The client sees the gap in sequence numbers and resyncs
+            self.queue.get_nowait()
+        self.queue.put_nowait((time.perf_counter(), payload))
+        return True
+
+    async def _write(self):
+        try:
+            while True:
+                queued_at, payload = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(payload), ROOM_SEND_TIMEOUT)
+                broadcast_delivery_seconds.observe(time.perf_counter() - queued_at)
+        except asyncio.TimeoutError:
+            self.room.send_failures += 1
+            self.abort("send timed out")
+        except Exception as e:
+            self.room.send_failures += 1
+            self.abort(f"send failed: {e}")
+
+    def abort(self, reason: str):
+        """Drop a connection that is dead or cannot keep up, and close its socket"""
+        if self.closed:
+            return
+        logger.info(f"Dropping {self.user_id} from room {self.room.room_id}: {reason}")
+        self.close()
+        spawn_background(leave_room(self.room, self))
+        spawn_background(self._close_socket())
+        # A half-open socket may never deliver a disconnect; stop waiting for one
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    async def _close_socket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1013), ROOM_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+
+class HeartbeatWheel:
+    """Hashed timer wheel: one task pings quiet sockets and reaps those that never answer"""
+
+    def __init__(self, interval: float, timeout: float, tick: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.slots: List[Set[RoomConnection]] = [set() for _ in range(math.ceil((interval + timeout) / tick) + 1)]
+        self.position = 0
+        self._task: Optional[asyncio.Task] = None
+        self.pings = 0
+        self.reaped = 0
+
+    def _schedule(self, connection: RoomConnection, delay: float):
+        ticks = min(len(self.slots) - 1, max(1, math.ceil(delay / self.tick)))
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot].add(connection)
+        connection.wheel_slot = slot
+
+    def add(self, connection: RoomConnection):
+        # Random first check so sockets that joined together don't get pinged on the same tick
+        self._schedule(connection, random.uniform(self.tick, self.interval))
+
+    def discard(self, connection: RoomConnection):
+        if connection.wheel_slot is not None:
+            self.slots[connection.wheel_slot].discard(connection)
+            connection.wheel_slot = None
+
+    def advance(self):
+        """Check the connections due this tick"""
+        self.position = (self.position + 1) % len(self.slots)
+        due = self.slots[self.position]
+        self.slots[self.position] = set()
+        now = time.monotonic()
+        for connection in due:
+            connection.wheel_slot = None
+            if connection.closed:
+                continue
+            # Any message counts as a sign of life, so busy sockets are never pinged
+            quiet = now - connection.last_seen
+            if quiet >= self.interval + self.timeout:
+                self.reaped += 1
+                connection.room.timeouts += 1
+                connection.abort("heartbeat timeout")
+            elif quiet >= self.interval:
+                self.pings += 1
+                connection.send(encode_message({'type': 'ping', 'server_time': server_clock()}))
+                self._schedule(connection, self.interval + self.timeout - quiet)
+            else:
+                self._schedule(connection, self.interval - quiet)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = spawn_background(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'interval': self.interval,
+            'timeout': self.timeout,
+            'tracked': sum(len(slot) for slot in self.slots),
+            'pings': self.pings,
+            'reaped': self.reaped
+        }
+
+
+heartbeats = HeartbeatWheel(ROOM_PING_INTERVAL, ROOM_PING_TIMEOUT, ROOM_HEARTBEAT_TICK)
+
+
+class RoomRegistry:
+    """All live rooms, with O(1) join/leave and TTL reaping of rooms nobody is connected to"""
+
+    def __init__(self, idle_ttl: float):
+        self.idle_ttl = idle_ttl
+        self._rooms: Dict[str, Room] = {}
+        # Empty rooms in the order they became empty, so a sweep only touches expired ones
+        self._idle: "OrderedDict[str, float]" = OrderedDict()
+        self._reaper: Optional[asyncio.Task] = None
+        self.connections = 0
+        self.created = 0
+        self.closed = 0
+        self.reaped = 0
+
+    def get(self, room_id: str) -> Optional[Room]:
+        return self._rooms.get(room_id)
+
+    def create(self, room_id: str, host_id: str) -> Room:
+        room = Room(room_id, host_id)
+        self._rooms[room_id] = room
+        self._idle[room_id] = time.monotonic()
+        self.created += 1
+        return room
+
+    def get_or_create(self, room_id: str, host_id: str) -> Room:
+        room = self._rooms.get(room_id)
+        return room if room is not None else self.create(room_id, host_id)
+
+    def join(self, room: Room, connection: RoomConnection):
+        if connection not in room.connections:
+            room.connections.add(connection)
+            room.joins += 1
+            self.connections += 1
+        self._idle.pop(room.room_id, None)
+        # A room reaped while this socket was connecting comes back
+        self._rooms.setdefault(room.room_id, room)
+
+    def drop(self, room: Room, connection: RoomConnection) -> bool:
+        """Forget a connection, returns whether it was still a member"""
+        if connection not in room.connections:
+            return False
+        room.connections.discard(connection)
+        room.leaves += 1
+        self.connections -= 1
+        if not room.connections and self._rooms.get(room.room_id) is room:
+            self._idle[room.room_id] = time.monotonic()
+        return True
+
+    def close(self, room: Room):
+        """Remove a room once its last connection has gone"""
+        if room.connections or self._rooms.get(room.room_id) is not room:
+            return
+        room.scheduler.cancel()
+        del self._rooms[room.room_id]
+        self._idle.pop(room.room_id, None)
+        self.closed += 1
+
+    def reap(self, limit: Optional[int] = None) -> int:
+        """Drop rooms that have been empty for longer than the TTL, returns how many went"""
+        cutoff = time.monotonic() - self.idle_ttl
+        reaped = 0
+        while self._idle and (limit is None or reaped < limit):
+            room_id, since = next(iter(self._idle.items()))
+            if since > cutoff:
+                break
+            del self._idle[room_id]
+            room = self._rooms.get(room_id)
+            if room is not None and not room.connections:
+                room.scheduler.cancel()
+                del self._rooms[room_id]
+                reaped += 1
+        self.reaped += reaped
+        return reaped
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(ROOM_REAP_INTERVAL)
+            reaped = batch = self.reap(ROOM_REAP_BATCH)
+            while batch == ROOM_REAP_BATCH:
+                await asyncio.sleep(0)
+                batch = self.reap(ROOM_REAP_BATCH)
+                reaped += batch
+            if reaped:
+                logger.info(f"Reaped {reaped} idle room(s)")
+            await room_backend.touch([room_id for room_id, room in self._rooms.items() if room.connections])
+
+    def start(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = spawn_background(self._reap_loop())
+
+    def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def stats(self) -> dict:
+        return {
+            'rooms': len(self._rooms),
+            'idle_rooms': len(self._idle),
+            'connections': self.connections,
+            'created': self.created,
+            'closed': self.closed,
+            'reaped': self.reaped,
+            'idle_ttl': self.idle_ttl
+        }
+
+
+rooms = RoomRegistry(ROOM_IDLE_TTL)
+
+
+class RoomBackend:
+    """Where room state and broadcasts live - this one keeps everything in the current process"""
+
+    name = "memory"
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def open_room(self, room_id: str, host_id: str) -> Optional[dict]:
+        """Shared state of a room, creating it with host_id if nobody has; None when not shared"""
+        return None
+
+    async def fetch_room(self, room_id: str) -> Optional[dict]:
+        return None
+
+    async def save_room(self, room: Room):
+        pass
+
+    async def add_listener(self, room: Room, delta: int) -> int:
+        """Record a join (+1) or leave (-1), returns the room's listener count"""
+        return len(room.connections)
+
+    async def publish(self, room_id: str, payload: str):
+        """Deliver an encoded broadcast to the room's connections in other processes"""
+
+    async def subscribe(self, room_id: str):
+        pass
+
+    async def unsubscribe(self, room_id: str):
+        pass
+
+    async def touch(self, room_ids: List[str]):
+        """Keep shared state of rooms that still have listeners from expiring"""
+
+    def stats(self) -> dict:
+        return {'backend': self.name}
+
+
+class RespError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RespConnection:
+    """Minimal RESP2 client over asyncio streams - enough for rooms, no redis package needed"""
+
+    def __init__(self, url: str, timeout: float):
+        self.url = urlparse(url)
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        url = self.url
+        if url.scheme == "unix":
+            connecting = asyncio.open_unix_connection(url.path)
+        else:
+            connecting = asyncio.open_connection(url.hostname or "localhost", url.port or 6379)
+        self.reader, self.writer = await asyncio.wait_for(connecting, self.timeout)
+        if url.password:
+            await self.execute("AUTH", *([unquote(url.username)] if url.username else []), unquote(url.password))
+        database = url.path.strip("/") if url.scheme != "unix" else parse_qs(url.query).get("db", [""])[0]
+        if database:
+            await self.execute("SELECT", database)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    @staticmethod
+    def encode(*args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            return None if size < 0 else (await self.reader.readexactly(size + 2))[:-2]
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [await self.read_reply() for _ in range(size)]
+        raise RespError(f"Unexpected reply {line[:20]!r}")
+
+    def send(self, *args):
+        self.writer.write(self.encode(*args))
+
+    async def execute(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    async def pipeline(self, commands: List[tuple]) -> list:
+        """Send several commands in one write and read their replies in order"""
+        self.writer.write(b"".join(self.encode(*command) for command in commands))
+        await self.writer.drain()
+        replies = []
+        for _ in commands:
+            try:
+                replies.append(await asyncio.wait_for(self.read_reply(), self.timeout))
+            except RespError as e:
+                replies.append(e)
+        return replies
+
+
+class RedisRoomBackend(RoomBackend):
+    """Room state in Redis hashes and broadcasts over Redis pub/sub, shared by every worker and replica"""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str, timeout: float):
+        self.url = url
+        self.prefix = prefix
+        self.timeout = timeout
+        self.node_id = uuid.uuid4().hex[:12]
+        self._commands = RespConnection(url, timeout)
+        self._command_lock = asyncio.Lock()
+        self._pubsub = RespConnection(url, timeout)
+        self._channels: Set[str] = set()
+        self._listener: Optional[asyncio.Task] = None
+        self.published = 0
+        self.delivered = 0
+        self.errors = 0
+
+    def _key(self, room_id: str) -> str:
+        return f"{self.prefix}:room:{room_id}"
+
+    def _channel(self, room_id: str) -> str:
+        return f"{self.prefix}:room-events:{room_id}"
+
+    async def start(self):
+        async with self._command_lock:
+            await self._commands.connect()
+        await self._pubsub.connect()
+        self._listener = spawn_background(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        self._pubsub.close()
+        self._commands.close()
+
+    async def _run(self, commands: List[tuple]) -> Optional[list]:
+        """Run commands on the shared connection; None (and a logged error) when the backend is unreachable"""
+        async with self._command_lock:
+            try:
+                if not self._commands.connected:
+                    await self._commands.connect()
+                replies = await self._commands.pipeline(commands)
+            except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                # The reply stream is out of step now; start over on the next call
+                self._commands.close()
+                self.errors += 1
+                logger.warning(f"Room backend unavailable: {e}")
+                return None
+            except asyncio.CancelledError:
+                # Replies still in flight would be read by the next caller
+                self._commands.close()
+                raise
+        for reply in replies:
+            if isinstance(reply, RespError):
+                self.errors += 1
+                logger.warning(f"Room backend error: {reply}")
+        return replies
+
+    @staticmethod
+    def _decode_state(fields: list) -> Optional[dict]:
+        if not fields:
+            return None
+        values = dict(zip(fields[::2], fields[1::2]))
+        state = json.loads(values.get(b'state') or b'{}')
+        state['host_id'] = values[b'host_id'].decode()
+        state['listener_count'] = int(values.get(b'listeners') or 0)
+        return state
+
+    async def open_room(self, room_id: str, host_id: str) -> Optional[dict]:
+        key = self._key(room_id)
+        replies = await self._run([
+            ("HSETNX", key, "host_id", host_id),
+            ("EXPIRE", key, ROOM_IDLE_TTL),
+            ("HGETALL", key)
+        ])
+        return self._decode_state(replies[2]) if replies and isinstance(replies[2], list) else None
+
+    async def fetch_room(self, room_id: str) -> Optional[dict]:
+        replies = await self._run([("HGETALL", self._key(room_id))])
+        return self._decode_state(replies[0]) if replies and isinstance(replies[0], list) else None
+
+    async def save_room(self, room: Room):
+        key = self._key(room.room_id)
+        state = room.state()
+        del state['host_id'], state['listener_count']
+        await self._run([
+            ("HSET", key, "host_id", room.host_id, "state", encode_message(state)),
+            ("EXPIRE", key, ROOM_IDLE_TTL)
+        ])
+
+    async def add_listener(self, room: Room, delta: int) -> int:
+        key = self._key(room.room_id)
+        replies = await self._run([("HINCRBY", key, "listeners", delta), ("EXPIRE", key, ROOM_IDLE_TTL)])
+        if not replies or not isinstance(replies[0], int):
+            return max(room.listeners + delta, len(room.connections))
+        if replies[0] <= 0:
+            # Last listener anywhere has gone, same as an in-process room closing
+            await self._run([("DEL", key)])
+            return 0
+        return replies[0]
+
+    async def publish(self, room_id: str, payload: str):
+        self.published += 1
+        await self._run([("PUBLISH", self._channel(room_id), f"{self.node_id} {payload}")])
+
+    async def subscribe(self, room_id: str):
+        channel = self._channel(room_id)
+        if channel not in self._channels:
+            self._channels.add(channel)
+            if self._pubsub.connected:
+                self._pubsub.send("SUBSCRIBE", channel)
+
+    async def unsubscribe(self, room_id: str):
+        channel = self._channel(room_id)
+        if channel in self._channels:
+            self._channels.discard(channel)
+            if self._pubsub.connected:
+                self._pubsub.send("UNSUBSCRIBE", channel)
+
+    async def touch(self, room_ids: List[str]):
+        for start in range(0, len(room_ids), ROOM_REAP_BATCH):
+            await self._run([("EXPIRE", self._key(room_id), ROOM_IDLE_TTL) for room_id in room_ids[start:start + ROOM_REAP_BATCH]])
+
+    async def _listen(self):
+        """Receive other processes' broadcasts, reconnecting (and resubscribing) when the link drops"""
+        channel_prefix = f"{self.prefix}:room-events:"
+        delay = 0.5
+        while True:
+            try:
+                if not self._pubsub.connected:
+                    await self._pubsub.connect()
+                if self._channels:
+                    self._pubsub.send("SUBSCRIBE", *self._channels)
+                delay = 0.5
+                while True:
+                    reply = await self._pubsub.read_reply()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        origin, _, payload = reply[2].decode().partition(" ")
+                        if origin != self.node_id:
+                            self.delivered += 1
+                            deliver_remote_broadcast(reply[1].decode()[len(channel_prefix):], payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Room backend subscription lost: {e}, retrying in {delay:.1f}s")
+                self._pubsub.close()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.name,
+            'node_id': self.node_id,
+            'connected': self._commands.connected and self._pubsub.connected,
+            'subscriptions': len(self._channels),
+            'published': self.published,
+            'delivered': self.delivered,
+            'errors': self.errors
+        }
+
+
+def create_room_backend() -> RoomBackend:
+    if ROOM_BACKEND == "redis":
+        return RedisRoomBackend(ROOM_BACKEND_URL, ROOM_BACKEND_PREFIX, ROOM_BACKEND_TIMEOUT)
+    if ROOM_BACKEND != "memory":
+        logger.warning(f"Unknown ROOM_BACKEND {ROOM_BACKEND!r}, keeping rooms in process")
+    return RoomBackend()
+
+
+room_backend = create_room_backend()
+
+
+def deliver_remote_broadcast(room_id: str, payload: str):
+    """Fan a broadcast published by another process out to this process's connections"""
+    room = rooms.get(room_id)
+    if room is None or not room.connections:
+        return
+    # Decoded once per process (not per connection) to keep the local mirror current
+    message = json.loads(payload)
+    if message.get('type') == 'state':
+        room.apply_delta(message)
+    elif 'listener_count' in message:
+        room.listeners = message['listener_count']
+    for connection in list(room.connections):
+        connection.send(payload)
+
+
 @app.post("/create-room")
 async def create_room():
     """Create a new listening room"""
     import secrets
     room_id = secrets.token_urlsafe(8)
     
-    active_rooms[room_id] = {
-        'host_id': f"host_{room_id}",
-        'current_song': None,
-        'is_playing': False,
-        'current_time': 0.0,
-        'last_update': datetime.now().isoformat(),
-        'listener_count': 0
-    }
-    
-    room_connections[room_id] = []
+    room = rooms.create(room_id, f"host_{room_id}")
+    await room_backend.save_room(room)
     
     return {
         'room_id': room_id,
-        'host_id': active_rooms[room_id]['host_id'],
+        'host_id': room.host_id,
         'message': 'Room created successfully'
     }
 
+async def refresh_idle_room(room: Room):
+    """Re-read shared state for a room with no connections here - this process isn't subscribed to it"""
+    if room.connections:
+        return
+    shared = await room_backend.fetch_room(room.room_id)
+    if shared is not None:
+        room.apply(shared)
+
 @app.get("/room/{room_id}")
 async def get_room_info(room_id: str):
     """Get room information"""
-    if room_id not in active_rooms:
-        raise HTTPException(status_code=404, detail="Room not found")
+    room = rooms.get(room_id)
+    if room is None:
+        # The room may live in another worker or replica
+        room_data = await room_backend.fetch_room(room_id)
+        if room_data is None:
+            raise HTTPException(status_code=404, detail="Room not found")
+        return room_data
+    await refresh_idle_room(room)
     
-    room_data = active_rooms[room_id].copy()
-    room_data['listener_count'] = len(room_connections.get(room_id, []))
+    room_data = room.state()
+    room_data['stats'] = room.stats()
     
     return room_data
 
@@ -698,130 +4256,188 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, user_id: str):
     """WebSocket endpoint for real-time sync"""
     await websocket.accept()
     
-    # Initialize room if it doesn't exist
-    if room_id not in active_rooms:
-        active_rooms[room_id] = {
-            'host_id': user_id,
-            'current_song': None,
-            'is_playing': False,
-            'current_time': 0.0,
-            'last_update': datetime.now().isoformat(),
-            'listener_count': 0
-        }
-        room_connections[room_id] = []
+    # Initialize room if it doesn't exist (here or in another process)
+    room = rooms.get(room_id)
+    if room is None:
+        shared = await room_backend.open_room(room_id, user_id)
+        room = rooms.get_or_create(room_id, shared['host_id'] if shared else user_id)
+        if shared:
+            room.apply(shared)
+    else:
+        await refresh_idle_room(room)
     
     # Add connection to room
-    room_connections[room_id].append(websocket)
-    active_rooms[room_id]['listener_count'] = len(room_connections[room_id])
+    connection = RoomConnection(websocket, user_id, room)
+    connection.task = asyncio.current_task()
+    if not room.connections:
+        await room_backend.subscribe(room_id)
+    rooms.join(room, connection)
+    heartbeats.add(connection)
+    room.listeners = await room_backend.add_listener(room, 1)
     
-    # Send current room state to new user
-    await websocket.send_text(json.dumps({
-        'type': 'room_state',
-        'data': active_rooms[room_id],
-        'is_host': user_id == active_rooms[room_id]['host_id']
-    }))
+    # A reconnecting client only needs what it missed; everyone else gets a snapshot
+    send_catch_up(room, connection, websocket.query_params.get('since'))
     
     # Notify others about new user
-    await broadcast_to_room(room_id, {
+    await broadcast_to_room(room, {
         'type': 'user_joined',
         'user_id': user_id,
-        'listener_count': active_rooms[room_id]['listener_count']
-    }, exclude=websocket)
+        'listener_count': room.listeners
+    }, exclude=connection)
     
     try:
         while True:
             data = await websocket.receive_text()
+            connection.last_seen = time.monotonic()
             message = json.loads(data)
+            room.messages += 1
             
+            if message.get('type') == 'pong':
+                pass
+            elif message.get('type') == 'clock':
+                # Clock-offset handshake: the client works out offset and RTT from t0 and its receive time
+                connection.send(encode_message({'type': 'clock', 't0': message.get('t0'), 'server_time': server_clock()}))
+            elif message.get('type') == 'resync':
+                send_catch_up(room, connection, message.get('since'))
             # Only host can control playback
-            if user_id == active_rooms[room_id]['host_id']:
-                await handle_host_message(room_id, message, websocket)
+            elif user_id == room.host_id:
+                await handle_host_message(room, message, connection)
             else:
-                await handle_listener_message(room_id, message, websocket)
+                await handle_listener_message(room, message, connection)
                 
     except WebSocketDisconnect:
-        # Remove connection
-        if room_id in room_connections:
-            room_connections[room_id] = [conn for conn in room_connections[room_id] if conn != websocket]
-            active_rooms[room_id]['listener_count'] = len(room_connections[room_id])
-            
-            # Notify others about user leaving
-            await broadcast_to_room(room_id, {
-                'type': 'user_left',
-                'user_id': user_id,
-                'listener_count': active_rooms[room_id]['listener_count']
-            })
-            
-            # Clean up empty rooms
-            if len(room_connections[room_id]) == 0:
-                del active_rooms[room_id]
-                del room_connections[room_id]
+        pass
+    except asyncio.CancelledError:
+        if not connection.closed:
+            raise
+        # Reaped as stale or too slow; abort() has already scheduled leave_room
+        return
+    except Exception as e:
+        logger.warning(f"WebSocket error in room {room_id}: {str(e)}")
+    
+    await leave_room(room, connection)
+
+async def leave_room(room: Room, connection: RoomConnection):
+    """Release a connection exactly once, whether it disconnected, went stale or fell behind"""
+    if connection.left:
+        return
+    connection.left = True
+    
+    # Remove connection
+    connection.close()
+    rooms.drop(room, connection)
+    heartbeats.discard(connection)
+    
+    # Clean up empty rooms (locally; other processes may still have listeners)
+    if not room.connections:
+        await room_backend.unsubscribe(room.room_id)
+        rooms.close(room)
+    
+    room.listeners = await room_backend.add_listener(room, -1)
+    
+    # Notify others about user leaving
+    await broadcast_to_room(room, {
+        'type': 'user_left',
+        'user_id': connection.user_id,
+        'listener_count': room.listeners
+    })
+
+def send_catch_up(room: Room, connection: RoomConnection, since):
+    """Send the deltas a client missed since a sequence number, or a snapshot if they are gone"""
+    try:
+        deltas = room.deltas_since(int(since)) if since is not None else None
+    except (TypeError, ValueError):
+        deltas = None
+    if deltas is None:
+        connection.send(encode_message(room.snapshot(connection.user_id == room.host_id)))
+    else:
+        connection.send(encode_message({'type': 'deltas', 'deltas': deltas, 'server_time': server_clock()}))
 
-async def handle_host_message(room_id: str, message: dict, websocket: WebSocket):
+def playback_position(message: dict) -> float:
+    try:
+        return max(0.0, float(message.get('current_time') or 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+async def handle_host_message(room: Room, message: dict, connection: RoomConnection):
     """Handle messages from room host"""
     msg_type = message.get('type')
     
     if msg_type == 'play':
-        active_rooms[room_id]['is_playing'] = True
-        active_rooms[room_id]['current_time'] = message.get('current_time', 0)
-        active_rooms[room_id]['last_update'] = datetime.now().isoformat()
+        changes = {'is_playing': True, 'current_time': playback_position(message)}
         
     elif msg_type == 'pause':
-        active_rooms[room_id]['is_playing'] = False
-        active_rooms[room_id]['current_time'] = message.get('current_time', 0)
-        active_rooms[room_id]['last_update'] = datetime.now().isoformat()
+        changes = {'is_playing': False, 'current_time': playback_position(message)}
         
     elif msg_type == 'seek':
-        active_rooms[room_id]['current_time'] = message.get('current_time', 0)
-        active_rooms[room_id]['last_update'] = datetime.now().isoformat()
+        changes = {'current_time': playback_position(message)}
         
     elif msg_type == 'song_change':
-        active_rooms[room_id]['current_song'] = message.get('song')
-        active_rooms[room_id]['current_time'] = 0
-        active_rooms[room_id]['is_playing'] = False
-        active_rooms[room_id]['last_update'] = datetime.now().isoformat()
-    
-    # Broadcast to all listeners
-    await broadcast_to_room(room_id, {
-        'type': msg_type,
-        'data': message,
-        'room_state': active_rooms[room_id]
-    }, exclude=websocket)
-
-async def handle_listener_message(room_id: str, message: dict, websocket: WebSocket):
+        changes = {'current_song': message.get('song'), 'current_time': 0.0, 'is_playing': False}
+        
+        # Every listener is about to resolve this song, and the host's queue tells us what comes next
+        song = message.get('song')
+        upcoming = [song.get('id')] if isinstance(song, dict) and song.get('source') == 'youtube' else []
+        if isinstance(message.get('upcoming'), list):
+            upcoming.extend(message['upcoming'][:PREFETCH_UPCOMING_LIMIT])
+        prefetcher.submit(upcoming)
+    
+    else:
+        # Keepalives and unknown messages are not room events
+        return
+    
+    # Broadcast to all listeners, merging scrubbing bursts; a song change always goes out at once
+    await room.scheduler.submit(changes, connection, urgent=msg_type == 'song_change')
+
+async def handle_listener_message(room: Room, message: dict, connection: RoomConnection):
     """Handle messages from listeners (limited actions)"""
     msg_type = message.get('type')
     
-    # Listeners can only send sync requests
+    # Listeners can only send sync requests (superseded by snapshots and deltas, kept for older clients)
     if msg_type == 'sync_request':
-        await websocket.send_text(json.dumps({
+        now = time.monotonic()
+        if now - connection.last_sync < ROOM_SYNC_INTERVAL:
+            room.throttled += 1
+            room_event_stats['throttled'] += 1
+            return
+        connection.last_sync = now
+        connection.send(encode_message({
             'type': 'sync_response',
-            'data': active_rooms[room_id]
+            'data': room.state()
         }))
 
-async def broadcast_to_room(room_id: str, message: dict, exclude: WebSocket = None):
+async def broadcast_to_room(room: Room, message: dict, exclude: Optional[RoomConnection] = None):
     """Broadcast message to all connections in a room"""
-    if room_id not in room_connections:
-        return
-    
-    disconnected = []
-    for connection in room_connections[room_id]:
-        if connection == exclude:
-            continue
-            
-        try:
-            await connection.send_text(json.dumps(message))
-        except:
-            disconnected.append(connection)
+    room.broadcasts += 1
+    started = time.perf_counter()
+    # Encode once; each connection's writer task does the actual (timed) send
+    payload = encode_message(message)
+    # Iterate a snapshot: the drop policy may remove slow connections as we go
+    for connection in list(room.connections):
+        if connection is not exclude:
+            connection.send(payload)
+    broadcast_fanout_seconds.observe(time.perf_counter() - started)
     
-    # Clean up disconnected connections
-    for conn in disconnected:
-        room_connections[room_id].remove(conn)
+    # Listeners connected to other workers or replicas
+    await room_backend.publish(room.room_id, payload)
 # Shutdown event
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on application shutdown"""
     logger.info("SpotifyClone API shutting down...")
+    prefetcher.stop()
+    rooms.stop()
+    heartbeats.stop()
+    loop_lag.stop()
+    watchdog.stop()
+    await room_backend.stop()
+    extraction_pool.shutdown()
+    search_pool.shutdown()
+    extractors.close()
+    persistent_cache.close()
+    library.close()
+    if http_client is not None:
+        await http_client.aclose()
 
 if __name__ == "__main__":
     import uvicorn
@@ -840,7 +4456,6 @@ if __name__ == "__main__":
 if __name__ == "__main__":
     import uvicorn
     import os
-    import sys
     
     print("🎵 Starting VoxWave Music Server...")
     print("📍 Server will be available at: http://localhost:8000")
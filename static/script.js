@@ -675,6 +675,54 @@ function saveQueue() {
         console.error('Failed to save queue:', error);
     }
 }
+// Prefer the server relay: one shared upstream download per song, and it outlives googlevideo URL expiry
+function playableUrl(data) {
+    return data.relay_url || data.url;
+}
+const pendingStreamIds = new Set(); // Video IDs with a batch resolution in flight
+async function resolveStreamsBatch(songs) {
+    // Resolve every unresolved YouTube song in one request instead of one round-trip per song
+    const videoIds = [...new Set(songs
+        .filter(song => song && song.source === 'youtube' && song.id && !song.url && !pendingStreamIds.has(song.id))
+        .map(song => song.id))];
+    if (videoIds.length === 0) return;
+
+    videoIds.forEach(id => pendingStreamIds.add(id));
+    try {
+        const response = await fetch(`${API_BASE_URL}/api/yt/stream:batch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ video_ids: videoIds })
+        });
+        if (!response.ok || !response.body) throw new Error(`HTTP ${response.status}`);
+
+        // Results arrive as NDJSON, one line per video as soon as it resolves
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const data = JSON.parse(line);
+                if (!data.url) continue;
+                songs.forEach(song => {
+                    if (song && song.id === data.video_id && !song.url) song.url = playableUrl(data);
+                });
+            }
+            if (done) break;
+        }
+        saveQueue();
+    } catch (error) {
+        // Songs left unresolved are fetched individually when they come up
+        console.error('Batch stream resolution failed:', error);
+    } finally {
+        videoIds.forEach(id => pendingStreamIds.delete(id));
+    }
+}
 function updateQueueViews() {
     updateQueueSectionView();
     updatePlayerQueueView();
@@ -781,7 +829,7 @@ async function playFromQueue(index = 0) {
                 const data = await response.json();
                 if (!data.url) throw new Error('No stream URL found');
 
-                song.url = data.url;
+                song.url = playableUrl(data);
                 song.title = song.title || data.title;
                 song.artist = song.artist || data.channel;
                 song.thumbnail = song.thumbnail || data.thumbnail;
@@ -813,6 +861,8 @@ async function playFromQueue(index = 0) {
             isPlayingFromQueue = true;
             saveQueue();
             updateQueueViews();
+            // Resolve the rest of the queue in the background
+            resolveStreamsBatch(queue);
             return true;
         } else {
             showNotification('Playback failed, skipping...', 'error');
@@ -1570,7 +1620,7 @@ async function playSong(song) {
                 const data = await response.json();
 
                 if (response.ok && data.url) {
-                    song.url = data.url;
+                    song.url = playableUrl(data);
                     audioPlayer.src = song.url;
                     await audioPlayer.play();
                     isPlaying = true;
@@ -1745,7 +1795,7 @@ async function playFromRecent(song) {
 
             if (data.url) {
                 // Update song with fresh URL and data
-                song.url = data.url;
+                song.url = playableUrl(data);
                 if (data.title) song.title = data.title;
                 if (data.channel) song.artist = data.channel;
                 if (data.thumbnail) song.thumbnail = data.thumbnail;
@@ -1896,7 +1946,7 @@ async function playFromSearch(id, title, artist, thumbnail) {
             id: id,
             title: data.title || title,
             artist: data.channel || artist,
-            url: data.url,
+            url: playableUrl(data),
             thumbnail: data.thumbnail || thumbnail,
             source: 'youtube'
         };
@@ -2082,7 +2132,7 @@ async function playFromLibrary(songId, fromLiked = false) {
                 const response = await fetch(`${API_BASE_URL}/api/yt/stream/${song.id}`);
                 const data = await response.json();
                 if (response.ok && data.url) {
-                    song.url = data.url;
+                    song.url = playableUrl(data);
                     if (data.title) song.title = data.title;
                     if (data.channel) song.artist = data.channel;
                     if (data.thumbnail) song.thumbnail = data.thumbnail;
@@ -2551,6 +2601,12 @@ const listenTogether = {
     reconnectAttempts: 0,
     maxReconnectAttempts: 3,
     reconnectDelay: 2000,
+    userId: null,
+    roomState: null, // Last snapshot with every delta since applied
+    seq: 0,
+    clockOffset: 0, // Server clock minus local clock, in ms
+    clockSamples: [],
+    clockRoundsLeft: 0,
 
     async createRoom() {
         try {
@@ -2581,6 +2637,9 @@ const listenTogether = {
             currentRoomId = data.room_id;
             isInRoom = true;
             isHost = true;
+            this.userId = data.host_id;
+            this.roomState = null;
+            this.seq = 0;
 
             // Connect WebSocket after setting room state
             setTimeout(() => {
@@ -2600,7 +2659,10 @@ const listenTogether = {
         }
 
         try {
-            const wsUrl = `ws://localhost:8000/ws/${currentRoomId}/${generateUserId()}`;
+            // Keep the same identity across reconnects, and ask only for what we missed
+            this.userId = this.userId || generateUserId();
+            const since = this.roomState ? `?since=${this.seq}` : '';
+            const wsUrl = `ws://localhost:8000/ws/${currentRoomId}/${this.userId}${since}`;
             console.log('Connecting to WebSocket:', wsUrl);
 
             this.socket = new WebSocket(wsUrl);
@@ -2610,11 +2672,9 @@ const listenTogether = {
                 this.reconnectAttempts = 0;
                 updateListenTogetherUI();
 
-                this.pingInterval = setInterval(() => {
-                    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
-                        this.socket.send(JSON.stringify({ type: 'ping' }));
-                    }
-                }, 30000);
+                // A burst of clock samples now, then one every 30s (which also keeps the socket alive)
+                this.syncClock(5);
+                this.pingInterval = setInterval(() => this.syncClock(1), 30000);
             };
 
             this.socket.onerror = (error) => {
@@ -2647,34 +2707,94 @@ const listenTogether = {
         }
     },
 
+    syncClock(rounds) {
+        if (!this.socket || this.socket.readyState !== WebSocket.OPEN) return;
+        this.clockRoundsLeft = rounds - 1;
+        this.socket.send(JSON.stringify({ type: 'clock', t0: Date.now() }));
+    },
+
+    handleClock(data) {
+        const t3 = Date.now();
+        const rtt = t3 - data.t0;
+        // Assume the reply spent half the round trip in flight; the lowest-RTT recent sample is the most accurate
+        this.clockSamples.push({ rtt, offset: data.server_time - (data.t0 + rtt / 2) });
+        this.clockSamples = this.clockSamples.slice(-8);
+        this.clockOffset = this.clockSamples.reduce((best, s) => s.rtt < best.rtt ? s : best).offset;
+
+        if (this.clockRoundsLeft > 0) {
+            this.clockRoundsLeft--;
+            this.socket.send(JSON.stringify({ type: 'clock', t0: Date.now() }));
+        }
+    },
+
+    serverNow() {
+        return Date.now() + this.clockOffset;
+    },
+
+    applyDelta(delta) {
+        if (!this.roomState || delta.seq <= this.seq) return;
+        if (delta.seq !== this.seq + 1) {
+            // Missed a delta (dropped while slow, or a reconnect); ask for the gap
+            this.socket.send(JSON.stringify({ type: 'resync', since: this.seq }));
+            return;
+        }
+        Object.assign(this.roomState, delta.changes);
+        this.roomState.at = delta.at;
+        this.seq = delta.seq;
+        this.applyRoomState();
+    },
+
+    applyRoomState() {
+        const state = this.roomState;
+        if (isHost || !state) return;
+        syncInProgress = true;
+
+        if (state.current_song && (!currentSong || state.current_song.id !== currentSong.id)) {
+            currentSong = state.current_song;
+            updatePlayerUI(currentSong);
+        }
+
+        if (state.is_playing && audioPlayer.paused) {
+            audioPlayer.play().catch(console.error);
+        } else if (!state.is_playing && !audioPlayer.paused) {
+            audioPlayer.pause();
+        }
+
+        // Where the host is now: the anchored position plus the time since it was anchored
+        const elapsed = state.is_playing ? Math.max(0, this.serverNow() - state.at) / 1000 : 0;
+        const position = state.current_time + elapsed;
+        if (Math.abs(audioPlayer.currentTime - position) > 0.5) {
+            audioPlayer.currentTime = position;
+        }
+
+        setTimeout(() => { syncInProgress = false; }, 100);
+    },
+
     handleMessage(data) {
         console.log('Received message:', data);
 
         switch (data.type) {
-            case 'room_state':
-                if (!isHost && data.data) {
-                    syncInProgress = true;
+            case 'ping':
+                // Server heartbeat; no answer gets the socket reaped
+                this.socket.send(JSON.stringify({ type: 'pong' }));
+                break;
 
-                    if (data.data.current_song && data.data.current_song !== currentSong) {
-                        currentSong = data.data.current_song;
-                        updatePlayerUI(currentSong);
-                    }
+            case 'clock':
+                this.handleClock(data);
+                break;
 
-                    if (data.data.is_playing && audioPlayer.paused) {
-                        audioPlayer.play().catch(console.error);
-                    } else if (!data.data.is_playing && !audioPlayer.paused) {
-                        audioPlayer.pause();
-                    }
+            case 'snapshot':
+                this.roomState = data.state;
+                this.seq = data.state.seq;
+                this.applyRoomState();
+                break;
 
-                    if (data.data.current_time !== undefined) {
-                        const timeDiff = Math.abs(audioPlayer.currentTime - data.data.current_time);
-                        if (timeDiff > 2) {
-                            audioPlayer.currentTime = data.data.current_time;
-                        }
-                    }
+            case 'deltas':
+                data.deltas.forEach(delta => this.applyDelta(delta));
+                break;
 
-                    setTimeout(() => { syncInProgress = false; }, 100);
-                }
+            case 'state':
+                this.applyDelta(data);
                 break;
 
             case 'user_joined':
@@ -2701,6 +2821,9 @@ const listenTogether = {
             currentRoomId = roomId.toUpperCase();
             isInRoom = true;
             isHost = false;
+            this.userId = null;
+            this.roomState = null;
+            this.seq = 0;
 
             this.connectSocket();
             return true;
@@ -2722,6 +2845,9 @@ const listenTogether = {
             isInRoom = false;
             isHost = false;
             syncInProgress = false;
+            this.userId = null;
+            this.roomState = null;
+            this.seq = 0;
 
             console.log('Left room');
         } catch (error) {
@@ -2752,6 +2878,11 @@ const listenTogether = {
                 break;
             case 'song_change':
                 message.song = currentSong;
+                // Let the server warm stream URLs for what plays next
+                message.upcoming = queue.concat(currentPlaylist.slice(currentIndex + 1))
+                    .filter(song => song && song.source === 'youtube' && song.id)
+                    .slice(0, 5)
+                    .map(song => song.id);
                 break;
         }
 